@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+"""
+Reproducible performance benchmarks of the conversion pipeline.
+
+    bench/suite.py pipeline [-repeat:<n>] [-jobs:<n>] [-o:<file>]
+    bench/suite.py overhead [-repeat:<n>] [-o:<file>]
+    bench/suite.py compare <old.json> <new.json>
+
+pipeline
+    End-to-end throughput with the real ffmpeg. Synthetic inputs of
+    various lengths, resolutions and codecs are generated with ffmpeg's
+    lavfi test sources (once; they are kept in bench/inputs). Each input
+    is converted with movie2android.convert(), then the whole set is
+    converted as one batch with -jobs:<n>.
+
+overhead
+    The cost of everything except the encoding. ffmpeg and mplayer are
+    replaced by the stubs in bench/stubs, which return immediately, so
+    the probing, process spawning, the conversion bookkeeping, the table
+    rendering and the latency of the server's job queue are measured.
+
+The suites run with a private, empty cache directory and without the
+output cache (see outputcache.py), so every conversion is an encode.
+
+The results are written as JSON (default: bench/results/<suite>-<date>.json).
+Two result files can be compared with `compare`.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'client_server'))
+
+import utils
+import movie2android as m2a
+
+INPUT_DIR = os.path.join(BENCH_DIR, 'inputs')
+RESULT_DIR = os.path.join(BENCH_DIR, 'results')
+STUB_DIR = os.path.join(BENCH_DIR, 'stubs')
+
+# name, seconds, size, video codec, audio codec, container
+CASES = [
+    ('vga-mpeg4-avi', 60, '640x480', 'mpeg4 -q:v 3', 'pcm_s16le', 'avi'),
+    ('720p-h264-mkv', 60, '1280x720', 'libx264 -preset ultrafast', 'aac -strict experimental', 'mkv'),
+    ('1080p-mpeg2-mpg', 30, '1920x1080', 'mpeg2video -q:v 3', 'mp2', 'mpg'),
+    ('hvga-h264-mp4', 120, '480x320', 'libx264 -preset ultrafast', 'aac -strict experimental', 'mp4'),
+]
+
+generate = """{ffmpeg} -f lavfi -i testsrc=duration={seconds}:size={size}:rate=25
+-f lavfi -i sine=frequency=440:duration={seconds} -codec:v {vcodec}
+-codec:a {acodec} -y \"{output}\"""".replace('\n', ' ')
+
+REPEAT = 3
+OVERHEAD_FILES = 20         # dummy inputs of the overhead suite
+TABLE_ROWS = 1000
+QUEUE_JOBS = 1000
+
+
+class Quiet(object):
+    """
+    Silence the standard output of movie2android during a measurement.
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, type, value, traceback): #@ReservedAssignment
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def record(name, samples, unit='sec', **extra):
+    """
+    A result entry with the samples and their statistics.
+    """
+    s = sorted(samples)
+    middle = len(s) // 2
+    median = s[middle] if len(s) % 2 else (s[middle-1] + s[middle]) / 2.0
+    entry = {'name': name, 'unit': unit, 'samples': samples,
+             'min': s[0], 'median': median, 'mean': sum(s) / len(s)}
+    entry.update(extra)
+    print "{0:<36} median {1:>12.6f} {2}".format(name, median, unit)
+    return entry
+
+
+def measure(name, func, repeat, **extra):
+    """
+    Call func() repeat times and record the wall time of the calls.
+    """
+    samples = []
+    for i in range(repeat):
+        start = time.time()
+        with Quiet():
+            func()
+        samples.append(time.time() - start)
+    return record(name, samples, **extra)
+
+
+def metadata(suite, options):
+    import platform
+    revision = utils.get_simple_cmd_output('git -C "{0}" rev-parse HEAD'.format(ROOT_DIR)).strip()
+    return {
+        'suite': suite,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_revision': revision if re.search(r'^[0-9a-f]{40}$', revision) else None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': utils.cpu_count(),
+        'options': options,
+    }
+
+#############################################################################
+##  pipeline  ###############################################################
+#############################################################################
+
+def make_inputs(conf):
+    """
+    Generate the synthetic inputs that don't exist yet. Return their paths.
+    """
+    if not os.path.isdir(INPUT_DIR):
+        os.makedirs(INPUT_DIR)
+    paths = []
+    for name, seconds, size, vcodec, acodec, ext in CASES:
+        path = os.path.join(INPUT_DIR, "{0}-{1}s.{2}".format(name, seconds, ext))
+        if not os.path.isfile(path):
+            print "Generating", path
+            cmd = generate.format(ffmpeg=conf['ffmpeg'], seconds=seconds, size=size,
+                                  vcodec=vcodec, acodec=acodec, output=path)
+            if utils.call_and_get_exit_code(cmd) != 0:
+                print "Warning: cannot generate {0}, skipped.".format(path)
+                continue
+        paths.append(path)
+    return paths
+
+
+def private_cache():
+    """
+    Point the caches of the process to a new temporary directory, so the
+    benchmarks neither hit nor fill the user's probe and output caches.
+    The calibration of the machine is copied over (see calibrate.py).
+    Return the directory.
+    """
+    import profiles
+    calibration = profiles.get_calibration_file()
+    cache_dir = tempfile.mkdtemp(prefix='m2a-bench-cache-')
+    os.environ['XDG_CACHE_HOME'] = cache_dir
+    if os.path.isfile(calibration):
+        shutil.copy(calibration, profiles.get_calibration_file())
+    return cache_dir
+
+
+def remove_output(result):
+    if result.file_name and os.path.isfile(result.file_name):
+        os.unlink(result.file_name)
+
+
+def pipeline(repeat, jobs):
+    conf = m2a.get_config()
+    paths = make_inputs(conf)
+    results = []
+    for path in paths:
+        length = utils.get_video_length(path)
+        samples = []
+        out_bytes = 0
+        for i in range(repeat):
+            with Quiet():
+                result = m2a.convert(path, output_cache=0)
+            remove_output(result)
+            if not result.status:
+                print "Warning: the conversion of {0} failed.".format(path)
+                break
+            samples.append(result.elapsed_time)
+            out_bytes = result.file_size
+        if samples:
+            entry = record('convert/' + os.path.basename(path), samples,
+                           media_seconds=length, output_bytes=out_bytes)
+            entry['realtime_factor'] = length / entry['median'] if entry['median'] else None
+            results.append(entry)
+    #
+    if paths:
+        batch_conf = m2a.get_config(jobs=jobs, output_cache=0)
+        media = sum(utils.get_video_length(p) for p in paths)
+        samples = []
+        for i in range(repeat):
+            start = time.time()
+            with Quiet():
+                batch = m2a.run_jobs(paths, batch_conf)
+            samples.append(time.time() - start)
+            for result in batch:
+                remove_output(result)
+        entry = record('batch/jobs={0}'.format(jobs), samples, media_seconds=media)
+        entry['realtime_factor'] = media / entry['median'] if entry['median'] else None
+        results.append(entry)
+    return results
+
+#############################################################################
+##  overhead  ###############################################################
+#############################################################################
+
+def overhead(repeat):
+    import probecache
+    import container
+    from jobqueue import JobQueue
+    from texttable import Texttable
+    #
+    work_dir = tempfile.mkdtemp(prefix='m2a-bench-')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')     # a cold, private cache
+    utils.MPLAYER = os.path.join(STUB_DIR, 'mplayer')
+    stub_ffmpeg = os.path.join(STUB_DIR, 'ffmpeg')
+    results = []
+    try:
+        files = []
+        for i in range(OVERHEAD_FILES):
+            path = os.path.join(work_dir, 'dummy{0:03}.avi'.format(i))
+            with open(path, 'wb') as f:
+                f.write('\0' * 1024)
+            files.append(path)
+        #
+        results.append(measure('spawn/true', lambda: utils.call_and_get_exit_code('/bin/true'), repeat * 10))
+        results.append(measure('spawn/stub_ffmpeg', lambda: utils.call_and_get_exit_code(stub_ffmpeg), repeat * 10))
+        results.append(measure('probe/mplayer_stub',
+                               lambda: utils.get_video_info(files[0], use_cache=False), repeat * 10))
+        utils.get_video_info(files[0])
+        results.append(measure('probe/cache_memory', lambda: utils.get_video_info(files[0]), repeat * 100))
+        db_file = os.path.join(utils.get_cache_dir(), 'probe.sqlite')
+        key = probecache.ProbeCache.key(files[0])
+        results.append(measure('probe/cache_disk',
+                               lambda: probecache.ProbeCache(db_file).get(key), repeat * 10))
+        natives = [p for p in sorted(os.listdir(INPUT_DIR))] if os.path.isdir(INPUT_DIR) else []
+        for name in natives:
+            path = os.path.join(INPUT_DIR, name)
+            results.append(measure('probe/native/' + name, lambda: container.get_info(path), repeat * 10))
+        #
+        def convert_all():
+            for path in files:
+                remove_output(m2a.convert(path, ffmpeg=stub_ffmpeg, output_cache=0))
+        results.append(measure('convert/stub_x{0}'.format(len(files)), convert_all, repeat))
+
+        def batch():
+            for result in m2a.run_jobs(files, m2a.get_config(ffmpeg=stub_ffmpeg, jobs=4, output_cache=0)):
+                remove_output(result)
+        results.append(measure('batch/stub_x{0}/jobs=4'.format(len(files)), batch, repeat))
+
+        def table():
+            t = Texttable()
+            t.set_cols_align(["r", "r", "r", "r", "r"])
+            t.add_rows([["Number", "File Name", "File Size", "Video Duration (H:MM:SS)", "Conversion Time"]] +
+                       [[i, 'movie{0}.mp4'.format(i), '1.00 MB', '1:30:00', '100.0 sec.'] for i in range(TABLE_ROWS)])
+            t.draw()
+        results.append(measure('table/{0}_rows'.format(TABLE_ROWS), table, repeat))
+        #
+        samples_add, samples_get = [], []
+        for i in range(repeat):
+            q = JobQueue(os.path.join(work_dir, 'queue{0}.sqlite'.format(i)))
+            start = time.time()
+            for n in range(QUEUE_JOBS):
+                q.add('/movies/{0}.avi'.format(n))
+            samples_add.append((time.time() - start) / QUEUE_JOBS)
+            start = time.time()
+            for n in range(QUEUE_JOBS):
+                q.done(q.get(timeout=0).id)
+            samples_get.append((time.time() - start) / QUEUE_JOBS)
+            q.close()
+        results.append(record('queue/enqueue', samples_add, unit='sec/job'))
+        results.append(record('queue/dequeue+done', samples_get, unit='sec/job'))
+        #
+        m2a_path = os.path.join(ROOT_DIR, 'movie2android.py')
+        results.append(measure('startup/help',
+                               lambda: utils.get_simple_cmd_output('"{0}" "{1}" --help'.format(sys.executable, m2a_path)),
+                               repeat * 3))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+#############################################################################
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = dict((r['name'], r) for r in json.load(f)['results'])
+    with open(new_file) as f:
+        new = json.load(f)['results']
+    for r in new:
+        if r['name'] in old and old[r['name']]['median']:
+            before = old[r['name']]['median']
+            change = 100.0 * (r['median'] - before) / before
+            print "{0:<36} {1:>12.6f} -> {2:>12.6f} {3} ({4:+.1f}%)".format(r['name'], before, r['median'],
+                                                                          r['unit'], change)
+        else:
+            print "{0:<36} {1:>12.6f} {2} (new)".format(r['name'], r['median'], r['unit'])
+
+
+def main(args):
+    repeat, jobs, output = REPEAT, 2, None
+    rest = []
+    for e in args:
+        m = re.search(r'^-(repeat|jobs):(\d+)$', e)
+        if m:
+            if m.group(1) == 'repeat':
+                repeat = max(1, int(m.group(2)))
+            else:
+                jobs = max(1, int(m.group(2)))
+            continue
+        m = re.search(r'^-o:(.+)$', e)
+        if m:
+            output = m.group(1)
+            continue
+        rest.append(e)
+    #
+    if rest[:1] == ['compare'] and len(rest) == 3:
+        return compare(rest[1], rest[2])
+    if rest not in (['pipeline'], ['overhead']):
+        print __doc__
+        sys.exit(1)
+    # else
+    suite = rest[0]
+    report = metadata(suite, {'repeat': repeat, 'jobs': jobs})
+    if suite == 'pipeline':
+        ffmpeg = m2a.get_config()['ffmpeg']
+        report['ffmpeg'] = utils.get_simple_cmd_output(ffmpeg + ' -version').split('\n')[0]
+    cache_dir = private_cache()
+    try:
+        report['results'] = pipeline(repeat, jobs) if suite == 'pipeline' else overhead(repeat)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if not output:
+        if not os.path.isdir(RESULT_DIR):
+            os.makedirs(RESULT_DIR)
+        output = os.path.join(RESULT_DIR, "{0}-{1}.json".format(suite, time.strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results:", output
+
+#############################################################################
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Throughput benchmark of the speed tiers.
+
+    ./movie2android.py benchmark [clip] [-seconds:<n>] [other switches]
+
+The reference clip is encoded with each speed tier (libx264 preset)
+using the current settings. For each tier the encoding speed (fps),
+the realtime factor (seconds of video encoded per second) and the size
+of the output are reported, so you can choose the tier of your machine
+from measured data. Without a clip, a synthetic one is generated with
+ffmpeg's lavfi test sources.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import utils
+import progress
+
+SECONDS = 30    # length of the synthetic clip
+
+# a 720p test pattern with a sine tone, stored almost losslessly
+make_clip = """{ffmpeg} -f lavfi -i testsrc=duration={seconds}:size=1280x720:rate=25
+-f lavfi -i sine=frequency=440:duration={seconds} -codec:v mpeg4 -q:v 2
+-codec:a pcm_s16le -y \"{output}\"""".replace('\n', ' ')
+
+
+class Measurement(object):
+    """
+    Result of encoding the reference clip with a speed tier.
+    """
+    def __init__(self, tier, preset):
+        self.tier = tier
+        self.preset = preset
+        self.status = False
+        self.fps = 0.0              # frames per second
+        self.realtime = 0.0         # seconds of video per wall-clock second
+        self.elapsed_time = 0.0     # wall-clock seconds
+        self.output_bytes = 0
+
+
+def encode(m2a, clip, length, tier, conf, work_dir):
+    """
+    Encode the clip with the given speed tier. Return a Measurement.
+    """
+    tier_conf = dict(conf, speed=tier)
+    tier_conf['x264_options'] = m2a.x264_options(tier_conf)
+    m = Measurement(tier, dict(m2a.SPEED_TIERS)[tier])
+    output = os.path.join(work_dir, "{0}.mp4".format(tier))
+    cmd = m2a.ffmpeg_command(tier_conf, clip, output, m2a.audio_codecs(tier_conf)[0])
+    last = []
+    printer = progress.ProgressPrinter(prefix="{0:>9}: ".format(tier))
+
+    def callback(p):
+        last[:] = [p]
+        printer(p)
+
+    timer = utils.Timer()
+    with timer:
+        exit_code = progress.call_with_progress(cmd, callback, length)
+    m.elapsed_time = timer.elapsed_time()
+    if exit_code != 0 or not os.path.isfile(output):
+        return m
+    # else
+    m.status = True
+    m.output_bytes = os.path.getsize(output)
+    if m.elapsed_time > 0:
+        frames = last[0].frame if last else 0
+        m.fps = frames / m.elapsed_time
+        m.realtime = length / m.elapsed_time
+    os.unlink(output)
+    return m
+
+
+def main(args, conf):
+    """
+    args: [clip] [-seconds:<n>]; conf: the result of movie2android.get_config().
+    """
+    import movie2android as m2a
+    from texttable import Texttable
+    #
+    seconds = SECONDS
+    clips = []
+    for e in args:
+        m = re.search(r'^-seconds:(\d+)$', e)
+        if m:
+            seconds = int(m.group(1))
+        else:
+            clips.append(e)
+    #
+    work_dir = tempfile.mkdtemp(prefix='m2a-benchmark-')
+    try:
+        if clips:
+            clip = clips[0]
+        else:
+            clip = os.path.join(work_dir, 'reference.avi')
+            print m2a.colored("Generating a {0} sec. reference clip...".format(seconds), "green")
+            cmd = make_clip.format(ffmpeg=conf['ffmpeg'], seconds=seconds, output=clip)
+            if utils.call_and_get_exit_code(cmd) != 0:
+                print m2a.colored("Error: the reference clip cannot be generated.", "red")
+                return []
+        length = utils.get_video_length(clip)
+        print m2a.colored("Reference clip: {0} ({1})".format(clip, utils.sec_to_hh_mm_ss(length)), "green")
+        results = [encode(m2a, clip, length, tier, conf, work_dir) for tier, _ in m2a.SPEED_TIERS]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    #
+    table = Texttable(max_width=100)
+    table.set_cols_align(["l", "l", "r", "r", "r", "r"])
+    table.set_cols_dtype(["t"] * 6)
+    rows = [["Speed Tier", "x264 Preset", "Encode FPS", "Realtime Factor", "Output Size", "Encode Time"]]
+    for r in results:
+        if r.status:
+            rows.append([r.tier, r.preset, "{0:.1f}".format(r.fps), "{0:.2f}x".format(r.realtime),
+                         utils.sizeof_fmt(r.output_bytes), "{0:.1f} sec.".format(r.elapsed_time)])
+        else:
+            rows.append([r.tier, r.preset, "--", "--", "--", m2a.FAILED])
+    table.add_rows(rows)
+    print table.draw()
+    print "Settings: {0}x{1}, {2}, -threads {3}".format(conf['width'], conf['height'],
+                                                       conf['bitrate'], conf['threads'])
+    return results
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Calibration of the threads per job and the number of parallel jobs.
+
+    ./movie2android.py calibrate [clip] [-seconds:<n>] [other switches]
+
+The reference clip is encoded with several combinations of ffmpeg
+threads per job and jobs running at the same time (threads x jobs is at
+most the number of CPU cores). For each combination the total throughput
+(seconds of video encoded per wall-clock second, all jobs together) is
+reported. The best combination is saved for this machine (see
+profiles.py) and is used as the default of -threads and -jobs, also by
+the conversion server. Without a clip, a short synthetic one is
+generated (see benchmark.py).
+
+Run it again after a hardware or an ffmpeg upgrade.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import utils
+import progress
+import profiles
+import benchmark
+
+SECONDS = 10    # length of the synthetic clip; every combination encodes it (jobs times)
+
+
+class Measurement(object):
+    """
+    Result of encoding the reference clip with a (threads, jobs) combination.
+    """
+    def __init__(self, threads, jobs):
+        self.threads = threads
+        self.jobs = jobs
+        self.status = False
+        self.elapsed_time = 0.0     # wall-clock seconds until the last job finished
+        self.throughput = 0.0       # seconds of video per wall-clock second, all jobs together
+
+    def as_dict(self):
+        return {'threads': self.threads, 'jobs': self.jobs, 'status': self.status,
+                'elapsed_time': round(self.elapsed_time, 3), 'throughput': round(self.throughput, 3)}
+
+
+def powers_of_two(n):
+    """
+    1, 2, 4, ... up to n, and n itself.
+    """
+    result = []
+    i = 1
+    while i <= n:
+        result.append(i)
+        i *= 2
+    if result[-1] != n:
+        result.append(n)
+    return result
+
+
+def combinations(cores):
+    """
+    The (threads, jobs) pairs to try on a machine with this many cores.
+    """
+    return [(threads, jobs) for threads in powers_of_two(cores)
+            for jobs in powers_of_two(cores) if threads * jobs <= cores]
+
+
+def encode(m2a, clip, length, threads, jobs, conf, work_dir):
+    """
+    Encode the clip jobs times at the same time. Return a Measurement.
+    """
+    m = Measurement(threads, jobs)
+    job_conf = dict(conf, threads=str(threads))
+    audio_codec = m2a.audio_codecs(job_conf)[0]
+    outputs = [os.path.join(work_dir, "{0}x{1}-{2}.mp4".format(threads, jobs, i)) for i in range(jobs)]
+    cmds = [m2a.ffmpeg_command(job_conf, clip, output, audio_codec) for output in outputs]
+    print m2a.colored("{0} thread(s) x {1} job(s)...".format(threads, jobs), "green")
+    timer = utils.Timer()
+    with timer:
+        exit_codes = utils.parallel_map(progress.call_with_progress, cmds, jobs)
+    m.elapsed_time = timer.elapsed_time()
+    m.status = all(code == 0 for code in exit_codes) and all(os.path.isfile(output) for output in outputs)
+    if m.status and m.elapsed_time > 0:
+        m.throughput = jobs * length / m.elapsed_time
+    for output in outputs:
+        if os.path.isfile(output):
+            os.unlink(output)
+    return m
+
+
+def main(args, conf):
+    """
+    args: [clip] [-seconds:<n>]; conf: the result of movie2android.get_config().
+    """
+    import movie2android as m2a
+    from texttable import Texttable
+    #
+    seconds = SECONDS
+    clips = []
+    for e in args:
+        m = re.search(r'^-seconds:(\d+)$', e)
+        if m:
+            seconds = int(m.group(1))
+        else:
+            clips.append(e)
+    #
+    cores = utils.cpu_count()
+    work_dir = tempfile.mkdtemp(prefix='m2a-calibrate-')
+    try:
+        if clips:
+            clip = clips[0]
+        else:
+            clip = os.path.join(work_dir, 'reference.avi')
+            print m2a.colored("Generating a {0} sec. reference clip...".format(seconds), "green")
+            cmd = benchmark.make_clip.format(ffmpeg=conf['ffmpeg'], seconds=seconds, output=clip)
+            if utils.call_and_get_exit_code(cmd) != 0:
+                print m2a.colored("Error: the reference clip cannot be generated.", "red")
+                return None
+        length = utils.get_video_length(clip)
+        print m2a.colored("Reference clip: {0} ({1}), {2} CPU core(s)".format(clip, utils.sec_to_hh_mm_ss(length), cores), "green")
+        results = [encode(m2a, clip, length, threads, jobs, conf, work_dir)
+                   for threads, jobs in combinations(cores)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    #
+    done = [r for r in results if r.status]
+    # on a tie, fewer jobs win (less memory, less disk traffic)
+    best = max(done, key=lambda r: (r.throughput, -r.jobs)) if done else None
+    #
+    table = Texttable(max_width=100)
+    table.set_cols_align(["r", "r", "r", "r", "l"])
+    table.set_cols_dtype(["t"] * 5)
+    rows = [["Threads", "Jobs", "Throughput", "Encode Time", ""]]
+    for r in results:
+        if r.status:
+            rows.append([r.threads, r.jobs, "{0:.2f}x".format(r.throughput),
+                         "{0:.1f} sec.".format(r.elapsed_time), "best" if r is best else ""])
+        else:
+            rows.append([r.threads, r.jobs, "--", "--", m2a.FAILED])
+    table.add_rows(rows)
+    print table.draw()
+    if best is None:
+        print m2a.colored("Error: every test encode failed, nothing was saved.", "red")
+        return None
+    # else
+    path = profiles.save_calibration(best.threads, best.jobs, [r.as_dict() for r in results])
+    print "Saved: -threads:{0} -jobs:{1} ({2})".format(best.threads, best.jobs, path)
+    return best
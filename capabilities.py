@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Encoders and filters supported by an ffmpeg binary.
+
+`ffmpeg -encoders` and `ffmpeg -filters` are called only once per binary.
+The result is cached in memory and on disk, keyed by the path and the
+modification time of the binary, so a new ffmpeg build is checked again.
+"""
+
+import os
+import re
+import json
+from subprocess import PIPE
+from distutils.spawn import find_executable
+from threading import Lock
+import utils
+
+CACHE_FILE = 'ffmpeg_capabilities.json'
+
+_cache = {}
+_lock = Lock()
+
+
+class Capabilities(object):
+    """
+    The encoders and filters of an ffmpeg binary.
+    """
+    def __init__(self, encoders, filters):
+        self.encoders = set(encoders)
+        self.filters = set(filters)
+
+    def has_encoder(self, name):
+        return name in self.encoders
+
+    def has_filter(self, name):
+        return name in self.filters
+
+
+def parse_encoders(output):
+    """
+    Encoder names from the output of `ffmpeg -encoders`.
+    Example line: " A..... aac    AAC (Advanced Audio Coding)"
+    """
+    return re.findall(r'(?m)^\s*[VASFXBD.]{6}\s+([^=\s]\S*)\s', output)
+
+
+def parse_filters(output):
+    """
+    Filter names from the output of `ffmpeg -filters`.
+    Example line: " ..C scale    V->V    Scale the input video size..."
+    """
+    return re.findall(r'(?m)^\s*[TSC.|]{0,3}\s*(\w+)\s+\S*->\S*\s', output)
+
+
+def _load_disk_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_disk_cache(path, data):
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+def get_capabilities(ffmpeg):
+    """
+    Capabilities of the given ffmpeg binary (a path or a command name
+    looked up in the PATH).
+
+    Return None if the binary cannot be found or queried.
+    """
+    binary = ffmpeg if os.path.isfile(ffmpeg) else find_executable(ffmpeg)
+    if not binary:
+        return None
+    binary = os.path.realpath(binary)
+    mtime = os.path.getmtime(binary)
+    #
+    with _lock:
+        key = (binary, mtime)
+        if key in _cache:
+            return _cache[key]
+        # else
+        cache_file = os.path.join(utils.get_cache_dir(), CACHE_FILE)
+        disk = _load_disk_cache(cache_file)
+        entry = disk.get(binary)
+        if entry and entry.get('mtime') == mtime:
+            caps = Capabilities(entry['encoders'], entry['filters'])
+        else:
+            encoders = parse_encoders(utils.get_simple_cmd_output('"{0}" -encoders'.format(binary), stderr=PIPE))
+            filters = parse_filters(utils.get_simple_cmd_output('"{0}" -filters'.format(binary), stderr=PIPE))
+            if not encoders:
+                return None     # not an ffmpeg we understand
+            caps = Capabilities(encoders, filters)
+            disk[binary] = {'mtime': mtime,
+                            'encoders': sorted(caps.encoders),
+                            'filters': sorted(caps.filters)}
+            _save_disk_cache(cache_file, disk)
+        _cache[key] = caps
+        return caps
+
+#############################################################################
+
+if __name__ == "__main__":
+    import sys
+    caps = get_capabilities(sys.argv[1] if len(sys.argv) > 1 else 'ffmpeg')
+    if caps is None:
+        print "ffmpeg not found"
+    else:
+        print "encoders:", ' '.join(sorted(caps.encoders))
+        print "filters:", ' '.join(sorted(caps.filters))
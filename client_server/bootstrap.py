@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+
+"""
+Makes movie2android and its modules importable by the server and the
+worker: they are imported from the directory of cfg.M2A (default: the
+parent directory). Import it before them.
+"""
+
+import os
+import sys
+import config as cfg
+
+if os.path.isfile(cfg.M2A):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(cfg.M2A)))
+else:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -1,29 +1,85 @@
 #!/usr/bin/env python
 
 import config as cfg
+import protocol
 import sys
 import socket
+import json
+import re
 import os
 
 
+def request(lines):
+    """
+    Send the command lines to the server on one connection.
+    Return the (verb, argument) pairs of the replies.
+    """
+    host = socket.gethostname()
+    client = socket.create_connection((host, cfg.PORT))
+    replies = client.makefile('rb')
+    for line in lines:
+        client.sendall(line)
+    result = [protocol.parse(replies.readline().rstrip(protocol.TERMINATOR)) for line in lines]
+    client.close()
+    return result
+
+
+def show_status():
+    verb, arg = request([protocol.command(protocol.STATUS)])[0]
+    if verb != protocol.OK:
+        print "Error: {m}".format(m=arg or 'no reply')
+        return
+    # else
+    status = json.loads(arg)
+    print "Workers: {w}, cores used: {u}/{c}, queued jobs: {q}".format(
+        w=status['workers'], u=status['cores_used'], c=status['cores'], q=status['queued'])
+    for slot in status['slots']:
+        if slot['job']:
+            print "  #{worker}: {state}, job #{job} ({running_for} sec.): {path}".format(**slot)
+        else:
+            print "  #{worker}: {state} ({processed} jobs done)".format(**slot)
+    for remote in status.get('remote', []):
+        print "  {worker} ({name}): {cores_used}/{cores} cores, jobs {jobs} ({processed} jobs done)".format(**remote)
+
+
 def main(elems):
-    try:
-        for e in elems:
-            fname = os.path.abspath(e)
-            if not os.path.isfile(fname):
-                print "Warning: {f} is not a file.".format(f=fname)
-                continue
-            # else
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            host = socket.gethostname()
-            client.connect((host, cfg.PORT))
-            client.send(fname)
-            client.shutdown(socket.SHUT_RDWR)
-            client.close()
-    except Exception as msg:
-        print msg
+    switches = []
+    files = []
+    for e in elems:
+        if e == '-status':
+            return show_status()
+        m = re.search(r'^-workers:(\d+)$', e)
+        if m:
+            verb, arg = request([protocol.command(protocol.WORKERS, m.group(1))])[0]
+            print "Workers: {n}".format(n=arg) if verb == protocol.OK else "Error: {m}".format(m=arg)
+            return
+        if re.search(r'^-(threads:\d+|speed:\S+|tune:\S+|profile:\S+|copy:\d)$', e):
+            switches.append(e)      # options of the jobs
+            continue
+        # else
+        fname = os.path.abspath(e)
+        if not os.path.isfile(fname):
+            print "Warning: {f} is not a file.".format(f=fname)
+            continue
+        # else
+        files.append(fname)
+    if not files:
+        return
+    # else
+    prefix = ''.join(s + ' ' for s in switches)
+    replies = request([protocol.command(protocol.ADD, prefix + path) for path in files])
+    for fname, (verb, arg) in zip(files, replies):
+        if verb == protocol.OK:
+            print "Queued as job #{i}: {f}".format(i=arg, f=fname)
+        elif verb == protocol.DUP:
+            print "Already in the queue as job #{i}: {f}".format(i=arg, f=fname)
+        else:
+            print "Error: {m} ({f})".format(m=arg or 'no reply', f=fname)
 
 #############################################################################
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    try:
+        main(sys.argv[1:])
+    except Exception as msg:
+        print msg
@@ -1,2 +1,21 @@
+import os
+
 PORT=3030
 M2A = '/home/jabba/Dropbox/python/movie2android/movie2android.py'
+QUEUE_DB = os.path.expanduser('~/.movie2android/queue.sqlite')
+THREADS = 0     # default number of ffmpeg threads per job (0: the machine's default, see calibrate.py)
+WORKERS = 0     # number of parallel jobs (0: the calibrated number, otherwise one per THREADS cores)
+
+# watch folders: new movies in these directories are queued automatically
+WATCH_DIRS = []         # e.g. ['/home/jabba/Downloads']
+WATCH_SETTLE = 10       # a new file is queued when it didn't change for this many seconds
+WATCH_POLL = 30         # polling interval in seconds (if inotify is not available)
+
+# remote workers (see worker.py) connect to this port of the server
+WORKER_PORT = 3031
+HEARTBEAT = 5           # a worker reports every this many seconds
+LEASE = 30              # the jobs of a worker that is silent this long are queued again
+
+# metrics in the Prometheus text format: http://METRICS_HOST:METRICS_PORT/metrics (see metrics.py)
+METRICS_PORT = 0        # 0: off, e.g. 9330
+METRICS_HOST = 'localhost'
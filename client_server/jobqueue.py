@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+Persistent job queue of the conversion server.
+
+The jobs are stored in an SQLite database (in WAL mode), thus the queue
+survives a restart or a crash of the server. A job is in one of the
+states queued, running, done and failed. A path can be in the queue
+only once at a time (while it's queued or running); jobs that were
+running when the server stopped are queued again on startup.
+"""
+
+import os
+import sys
+import time
+import json
+import sqlite3
+from threading import Condition
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class Job(object):
+    """
+    A record of the queue.
+    """
+    def __init__(self, job_id, path, state, threads=None, options=None, created=None):
+        self.id = job_id
+        self.path = path
+        self.state = state
+        self.threads = threads  # number of ffmpeg threads (None: the server's default)
+        self.options = json.loads(options) if options else {}     # other options of convert()
+        self.created = created  # time when the job was queued
+
+    def __str__(self):
+        return "#{0} {1} ({2})".format(self.id, self.path, self.state)
+
+
+class JobQueue(object):
+    """
+    FIFO queue of movie files to be converted.
+
+    The methods can be called from several threads.
+    """
+    def __init__(self, db_file):
+        folder = os.path.dirname(db_file)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.conn.text_factory = str    # paths are byte strings, in any encoding
+        self.cond = Condition()
+        with self.cond:
+            c = self.conn
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                             id INTEGER PRIMARY KEY AUTOINCREMENT,
+                             path TEXT NOT NULL,
+                             state TEXT NOT NULL,
+                             created REAL,
+                             started REAL,
+                             finished REAL)""")
+            columns = [row[1] for row in c.execute("PRAGMA table_info(jobs)")]
+            if 'threads' not in columns:
+                c.execute("ALTER TABLE jobs ADD COLUMN threads INTEGER")
+            if 'options' not in columns:
+                c.execute("ALTER TABLE jobs ADD COLUMN options TEXT")
+            # a path can be queued/running only once
+            c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_path ON jobs (path)
+                         WHERE state IN ('queued', 'running')""")
+            c.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+            c.commit()
+        self.recovered = self.recover()
+
+    def recover(self):
+        """
+        Queue again the jobs that were running when the server stopped.
+        Return the number of such jobs.
+        """
+        with self.cond:
+            cur = self.conn.execute("UPDATE jobs SET state=?, started=NULL WHERE state=?", (QUEUED, RUNNING))
+            self.conn.commit()
+            return cur.rowcount
+
+    def add(self, path, threads=None, options=None):
+        """
+        Add a path to the queue.
+
+        Return (job id, True) if a new job was created. If the path
+        is already queued or running, return (its job id, False).
+        """
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        with self.cond:
+            try:
+                cur = self.conn.execute("INSERT INTO jobs (path, state, created, threads, options) VALUES (?, ?, ?, ?, ?)",
+                                        (path, QUEUED, time.time(), threads,
+                                         json.dumps(options) if options else None))
+                self.conn.commit()
+            except sqlite3.IntegrityError:
+                self.conn.rollback()
+                row = self.conn.execute("SELECT id FROM jobs WHERE path=? AND state IN (?, ?)",
+                                        (path, QUEUED, RUNNING)).fetchone()
+                return row[0], False
+            self.cond.notify()
+            return cur.lastrowid, True
+
+    def get(self, timeout=None):
+        """
+        Take the oldest queued job and mark it running.
+
+        Wait at most timeout seconds for a job. Return None if there is none.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                row = self.conn.execute("SELECT id, path, threads, options, created FROM jobs WHERE state=? ORDER BY id LIMIT 1",
+                                        (QUEUED,)).fetchone()
+                if row:
+                    cur = self.conn.execute("UPDATE jobs SET state=?, started=? WHERE id=? AND state=?",
+                                            (RUNNING, time.time(), row[0], QUEUED))
+                    self.conn.commit()
+                    if cur.rowcount == 1:
+                        return Job(row[0], row[1], RUNNING, row[2], row[3], row[4])
+                    continue    # taken by another process
+                # else
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+
+    def requeue(self, job_id):
+        """
+        Put a running job back to the queue (e.g. its remote worker died).
+        """
+        with self.cond:
+            cur = self.conn.execute("UPDATE jobs SET state=?, started=NULL WHERE id=? AND state=?",
+                                    (QUEUED, job_id, RUNNING))
+            self.conn.commit()
+            if cur.rowcount:
+                self.cond.notify()
+            return cur.rowcount == 1
+
+    def _finish(self, job_id, state):
+        with self.cond:
+            self.conn.execute("UPDATE jobs SET state=?, finished=? WHERE id=?", (state, time.time(), job_id))
+            self.conn.commit()
+
+    def done(self, job_id):
+        self._finish(job_id, DONE)
+
+    def failed(self, job_id):
+        self._finish(job_id, FAILED)
+
+    def jobs(self, state):
+        """
+        Jobs in the given state, oldest first.
+        """
+        with self.cond:
+            rows = self.conn.execute("SELECT id, path, state, threads, options FROM jobs WHERE state=? ORDER BY id",
+                                     (state,)).fetchall()
+        return [Job(*row) for row in rows]
+
+    def count(self, state):
+        with self.cond:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state=?", (state,)).fetchone()[0]
+
+    def close(self):
+        with self.cond:
+            self.conn.close()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+Metrics of the conversion server in the Prometheus text format.
+
+If METRICS_PORT is set in config.py, the server answers
+
+    http://localhost:<METRICS_PORT>/metrics
+
+Counters and histograms are updated by the threads of the server as the
+jobs go; gauges (e.g. the queue depth) are read when they are scraped.
+Counters start from 0 when the server starts (Prometheus handles that).
+
+The realtime factor of the encodes is
+
+    rate(m2a_media_seconds_total[10m]) / rate(m2a_encode_seconds_total[10m])
+
+Only the Python standard library is used (BaseHTTPServer).
+"""
+
+import math
+from threading import Thread, Lock
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    # else
+    return str(value)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    # else
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join('{0}="{1}"'.format(k, v) for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Metric(object):
+    """
+    Base class: a named metric with optional labels.
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+
+    def header(self):
+        return ["# HELP {0} {1}".format(self.name, self.help),
+                "# TYPE {0} {1}".format(self.name, self.kind)]
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        return self.header() + self.samples()
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, one per combination of label values.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = {}
+        if not self.labels:
+            self.values[()] = 0
+
+    def inc(self, amount=1, labels=()):
+        """
+        labels: the label values, in the order of the label names.
+        """
+        key = tuple(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return ["{0}{1} {2}".format(self.name, format_labels(self.labels, key), format_value(value))
+                for key, value in items]
+
+
+class Gauge(Metric):
+    """
+    A value read by a callback at scrape time. With labels, the callback
+    returns {(label values): value}.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        items = sorted(value.items()) if self.labels else [((), value)]
+        return ["{0}{1} {2}".format(self.name, format_labels(self.labels, key), format_value(v))
+                for key, v in items]
+
+
+class Histogram(Metric):
+    """
+    Observations counted in cumulative buckets (upper bounds in seconds).
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append("{0}_bucket{1} {2}".format(self.name, format_labels((), (), [('le', format_value(float(bound)))]),
+                                                    cumulative))
+        lines.append("{0}_sum {1}".format(self.name, format_value(total)))
+        lines.append("{0}_count {1}".format(self.name, count))
+        return lines
+
+
+class Registry(object):
+    """
+    The metrics of a process, rendered in the order they were created.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, callback, labels=()):
+        return self.add(Gauge(name, help, callback, labels))
+
+    def histogram(self, name, help, buckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(Thread):
+    """
+    Serves the metrics of a registry over HTTP (GET /metrics).
+    """
+    def __init__(self, registry, host, port):
+        super(MetricsServer, self).__init__()
+        self.daemon = True
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.registry = registry
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        # else
+        try:
+            body = self.server.registry.render()
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # a scrape every few seconds would flood the console
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""
+The protocol between the client and the server.
+
+Messages are newline-terminated lines. The client sends commands,
+the server answers every command with exactly one line:
+
+    client: ADD /abs/path/movie.avi
+    server: OK 42               (queued as job #42)
+    server: DUP 17              (already queued/running as job #17)
+    server: ERR <message>
+
+    client: ADD -threads:4 -speed:fast /abs/path/movie.avi
+    server: OK 43               (the job will use 4 threads and the 'fast' tier)
+
+    client: STATUS
+    server: OK {"workers": 2, "slots": [...], ...}      (JSON)
+
+    client: WORKERS 3
+    server: OK 3                (the pool was resized to 3 workers)
+
+A client can send any number of commands on one connection.
+
+Remote workers (see worker.py) talk to the coordinator on another port
+(WORKER_PORT) with JSON objects, one per line:
+
+    worker:      {"type": "register", "name": "box2", "cores": 8}
+    coordinator: {"type": "registered", "worker": 3, "heartbeat": 5, "lease": 30}
+    coordinator: {"type": "job", "job": 42, "path": "/abs/path/movie.avi", "path_b64": "L2Ficy9w...",
+                  "threads": 2, "options": {}}
+    worker:      {"type": "heartbeat", "jobs": [42]}     (every `heartbeat` seconds)
+    worker:      {"type": "done", "job": 42, "ok": true, "result": {"elapsed_time": 61.2, ...}}
+
+A file name can be any byte string, which JSON cannot carry: the path
+of a job is sent as text for people ("path", the bytes that are not
+UTF-8 are replaced) and as the exact bytes in base64 ("path_b64").
+
+The result of a "done" message (see result_fields()) is optional; it
+feeds the metrics of the server.
+
+A job is leased to a worker: the lease is renewed by the heartbeats. If
+a worker disconnects or its lease expires, its jobs are queued again.
+"""
+
+import re
+import json
+import base64
+
+ADD, STATUS, WORKERS = 'ADD', 'STATUS', 'WORKERS'
+OK, DUP, ERR = 'OK', 'DUP', 'ERR'
+
+REGISTER, REGISTERED, JOB, HEARTBEAT, DONE = 'register', 'registered', 'job', 'heartbeat', 'done'
+
+TERMINATOR = '\n'
+MAX_LINE = 64 * 1024    # longer lines are refused
+
+
+def command(verb, arg=''):
+    """
+    A line to send. The argument must not contain a newline.
+    """
+    if TERMINATOR in arg:
+        raise ValueError("a newline cannot be sent: {0!r}".format(arg))
+    return "{0} {1}{2}".format(verb, arg, TERMINATOR) if arg else verb + TERMINATOR
+
+
+def parse(line):
+    """
+    Split a received line (without the terminator) into (verb, argument).
+    """
+    verb, _, arg = line.rstrip('\r').partition(' ')
+    return verb.upper(), arg
+
+
+def split_options(arg):
+    """
+    Split the argument of ADD into (options, path), where options is a
+    dictionary of the leading -threads/-speed/-tune/-profile/-copy switches.
+    """
+    options = {}
+    while True:
+        m = re.search(r'^-(threads|speed|tune|profile|copy):(\S+) (.+)$', arg)
+        if not m:
+            return options, arg
+        # else
+        options[m.group(1)] = m.group(2)
+        arg = m.group(3)
+
+
+def message(kind, **fields):
+    """
+    A JSON line of the worker protocol.
+    """
+    fields['type'] = kind
+    return json.dumps(fields) + TERMINATOR
+
+
+def path_fields(path):
+    """
+    The fields of a path (a byte string) in a message (see the module docstring).
+    """
+    return {'path': path.decode('utf-8', 'replace'), 'path_b64': base64.b64encode(path)}
+
+
+def message_path(msg):
+    """
+    The path of a message as a byte string.
+    """
+    if 'path_b64' in msg:
+        return base64.b64decode(msg['path_b64'])
+    # else
+    return msg['path'].encode('utf-8')
+
+
+def parse_message(line):
+    """
+    Decode a line of the worker protocol. Return None if it's not a valid message.
+    """
+    try:
+        msg = json.loads(line)
+    except ValueError:
+        return None
+    return msg if isinstance(msg, dict) and 'type' in msg else None
+
+
+RESULT_FIELDS = ('elapsed_time', 'video_length', 'probe_time', 'file_size', 'skipped', 'cached')
+
+
+def result_fields(result):
+    """
+    The fields of a movie2android.Result that the metrics need (a dict).
+    None (e.g. the conversion raised an exception) gives {}.
+    """
+    if result is None:
+        return {}
+    # else
+    return dict((name, getattr(result, name, None)) for name in RESULT_FIELDS)
@@ -1,81 +1,560 @@
 #!/usr/bin/env python
 
 import socket
-import select
+import asyncore
+import asynchat
 import config as cfg
-import Queue
-from threading import Thread
+import protocol
+from jobqueue import JobQueue, QUEUED, RUNNING
+from threading import Thread, Condition, Lock
+import traceback
+import json
+import time
 import sys
-import os
+
+import bootstrap    # makes movie2android importable #@UnusedImport
+import movie2android
+import tracing
+import utils
+from watcher import Watcher
+import metrics
+
+# The threads per job and the number of workers come from config.py. If they
+# are 0 there, the defaults of this machine are used: the result of
+# "movie2android.py calibrate" if it was run, otherwise movie2android's settings.
+MACHINE = movie2android.profiles.machine_profile()
+THREADS = cfg.THREADS or int(movie2android.get_config()['threads'])
+WORKERS = cfg.WORKERS or (int(MACHINE['jobs']) if 'jobs' in MACHINE and not cfg.THREADS else 0)
+
+
+class CoreBudget(object):
+    """
+    The CPU cores shared by the running jobs.
+
+    A job with n threads waits until n cores are free. A job
+    that is bigger than the whole budget can run alone.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        self.cond = Condition()
+
+    def acquire(self, n):
+        with self.cond:
+            while self.used > 0 and self.used + n > self.total:
+                self.cond.wait(1)
+            self.used += n
+
+    def release(self, n):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
 
 
 class ProcessThread(Thread):
-    def __init__(self):
+    """
+    A worker slot of the pool. Takes jobs from the shared queue one by one.
+    """
+    def __init__(self, pool, number):
         super(ProcessThread, self).__init__()
+        self.daemon = True
+        self.pool = pool
+        self.number = number
         self.running = True
-        self.q = Queue.Queue()
-
-    def add(self, data):
-        self.q.put(data)
+        self.job = None         # the current job
+        self.waiting = False    # is the current job waiting for free cores?
+        self.started = None     # start time of the current job
+        self.processed = 0      # number of jobs finished by this worker
 
     def stop(self):
         self.running = False
 
+    def status(self):
+        job, waiting = self.job, self.waiting
+        if job:
+            state = 'waiting for cores' if waiting else 'busy'
+        else:
+            state = 'idle' if self.running else 'stopping'
+        return {
+            'worker': self.number,
+            'state': state,
+            'job': job.id if job else None,
+            'path': job.path if job else None,
+            'threads': (job.threads or THREADS) if job else None,
+            'running_for': round(time.time() - self.started, 1) if job and not waiting else 0.0,
+            'processed': self.processed,
+        }
+
     def run(self):
-        q = self.q
+        q = self.pool.q
         while self.running:
+            job = q.get(timeout=1)
+            if job is None:
+                if self.number == 1:
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
+                continue
+            # else
+            threads = job.threads or THREADS
+            self.job, self.waiting = job, True
+            with tracing.span('wait for cores', job=job.id, threads=threads):
+                self.pool.budget.acquire(threads)
+            self.started, self.waiting = time.time(), False
+            job_started(job)
             try:
-                value = q.get(block=True, timeout=1)
-                process(value)
-            except Queue.Empty:
-                sys.stdout.write('.')
-                sys.stdout.flush()
+                with tracing.span('server job', job=job.id, path=job.path, threads=threads):
+                    result = process(job.path, threads, len(self.pool.workers), job.options)
+            finally:
+                self.pool.budget.release(threads)
+                self.job = None
+            ok = bool(result and result.status)
+            job_finished('local', ok, protocol.result_fields(result))
+            if ok:
+                q.done(job.id)
+            else:
+                q.failed(job.id)
+            self.processed += 1
+        self.pool.retire(self)
+
+
+class WorkerPool(object):
+    """
+    Worker slots that pull from the shared job queue.
+
+    By default there is one worker per THREADS cores. The number
+    of workers can be changed while the server is running.
+    """
+    def __init__(self, size=None):
+        self.q = JobQueue(cfg.QUEUE_DB)
+        if self.q.recovered:
+            print "{n} interrupted job(s) queued again.".format(n=self.q.recovered)
+        cores = utils.cpu_count()
+        self.budget = CoreBudget(cores)
+        self.lock = Lock()
+        self.workers = []
+        self.retired = []
+        self.resize(size or max(1, cores // THREADS))
+
+    def add(self, data, threads=None, options=None):
+        job_id, new = self.q.add(data, max(1, threads) if threads else None, options)
+        if not new:
+            print "# already in the queue (job #{i}): {f}".format(i=job_id, f=data)
+        return job_id, new
+
+    def resize(self, size):
+        """
+        Change the number of workers. Superfluous workers
+        stop after finishing their current job.
+        """
+        size = max(1, size)
+        with self.lock:
+            while len(self.workers) < size:
+                numbers = set(w.number for w in self.workers + self.retired)
+                number = min(set(range(1, len(numbers) + 2)) - numbers)
+                worker = ProcessThread(self, number)
+                self.workers.append(worker)
+                worker.start()
+            while len(self.workers) > size:
+                worker = self.workers.pop()
+                worker.stop()
+                self.retired.append(worker)
+        return size
+
+    def retire(self, worker):
+        with self.lock:
+            if worker in self.retired:
+                self.retired.remove(worker)
+
+    def status(self):
+        with self.lock:
+            workers = self.workers + self.retired
+        return {
+            'workers': len(self.workers),
+            'cores': self.budget.total,
+            'cores_used': self.budget.used,
+            'queued': self.q.count(QUEUED),
+            'slots': [w.status() for w in sorted(workers, key=lambda w: w.number)],
+        }
+
+    def stop(self):
+        with self.lock:
+            workers = self.workers + self.retired
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
         #
-        if not q.empty():
-            print "Elements left in the queue:"
-            while not q.empty():
-                print q.get()
+        left = self.q.jobs(QUEUED)
+        if left:
+            print "Elements left in the queue (they are processed after a restart):"
+            for job in left:
+                print job.path
+
+
+# metrics of the server (see metrics.py)
+registry = metrics.Registry()
+registry.gauge('m2a_queue_depth', 'Jobs waiting in the queue.', lambda: pool.q.count(QUEUED))
+registry.gauge('m2a_jobs_running', 'Jobs being converted (local and remote).', lambda: pool.q.count(RUNNING))
+registry.gauge('m2a_workers', 'Local worker slots and connected remote workers.',
+               lambda: {('local',): len(pool.workers), ('remote',): len(coordinator.workers) if coordinator else 0},
+               ('kind',))
+JOBS_COMPLETED = registry.counter('m2a_jobs_completed_total', 'Jobs finished successfully.', ('worker', 'result'))
+JOBS_FAILED = registry.counter('m2a_jobs_failed_total', 'Jobs that failed.', ('worker',))
+ENCODE_SECONDS = registry.counter('m2a_encode_seconds_total',
+                                  'Wall-clock seconds of the conversions (skipped and cached jobs excluded).')
+MEDIA_SECONDS = registry.counter('m2a_media_seconds_total',
+                                 'Seconds of video converted (skipped and cached jobs excluded).')
+OUTPUT_BYTES = registry.counter('m2a_output_bytes_total',
+                                'Bytes of the outputs written (skipped and cached jobs excluded).')
+PROBE_SECONDS = registry.histogram('m2a_probe_seconds', 'Time to probe an input.',
+                                   (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+QUEUE_WAIT = registry.histogram('m2a_queue_wait_seconds', 'Time from queueing a job to its start.',
+                                (1, 10, 60, 300, 900, 3600, 4 * 3600, 24 * 3600))
+
+
+def job_started(job):
+    if job.created:
+        QUEUE_WAIT.observe(max(0.0, time.time() - job.created))
+
+
+def job_finished(worker, ok, fields):
+    """
+    Update the metrics with a finished job. worker is 'local' or 'remote',
+    fields are the result of protocol.result_fields().
+    """
+    if fields.get('probe_time') is not None:
+        PROBE_SECONDS.observe(fields['probe_time'])
+    if not ok:
+        JOBS_FAILED.inc(labels=(worker,))
+        return
+    # else
+    kind = 'skipped' if fields.get('skipped') else 'cached' if fields.get('cached') else 'encoded'
+    JOBS_COMPLETED.inc(labels=(worker, kind))
+    if kind == 'encoded':
+        ENCODE_SECONDS.inc(fields.get('elapsed_time') or 0.0)
+        MEDIA_SECONDS.inc(fields.get('video_length') or 0.0)
+        OUTPUT_BYTES.inc(fields.get('file_size') or 0)
+
+
+pool = WorkerPool(WORKERS)
+watcher = None
+coordinator = None
+metrics_server = None
+
+
+def process(value, threads, jobs, options):
+    """
+    Convert a file in this process (no new Python interpreter per job).
+
+    jobs is the number of parallel jobs, options are the other options
+    of the job (e.g. speed). Return the movie2android.Result or None if
+    the conversion raised an exception.
+    """
+    print '#', value
+    try:
+        return movie2android.convert(value, threads=threads, jobs=jobs, **options)
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+class ClientHandler(asynchat.async_chat):
+    """
+    A client connection. Every line is a command (see protocol.py),
+    which is answered right away.
+    """
+    def __init__(self, sock):
+        asynchat.async_chat.__init__(self, sock)
+        self.set_terminator(protocol.TERMINATOR)
+        self.data = []
+        self.size = 0
+
+    def collect_incoming_data(self, data):
+        self.data.append(data)
+        self.size += len(data)
+        if self.size > protocol.MAX_LINE:
+            self.push(protocol.command(protocol.ERR, 'line too long'))
+            self.close_when_done()
+            self.data, self.size = [], 0
+
+    def found_terminator(self):
+        line = ''.join(self.data)
+        self.data, self.size = [], 0
+        self.push(answer(line))
+
+
+def answer(line):
+    """
+    Execute a command and return the reply line. If the command fails,
+    the reply is an error (the connection stays open).
+    """
+    try:
+        return execute(line)
+    except Exception as e:
+        traceback.print_exc()
+        return protocol.command(protocol.ERR, ' '.join("{0}: {1}".format(type(e).__name__, e).split()))
+
+
+def execute(line):
+    """
+    Execute a command and return the reply line.
+    """
+    verb, arg = protocol.parse(line)
+    if verb == protocol.ADD and arg:
+        options, path = protocol.split_options(arg)
+        threads = options.pop('threads', None)
+        job_id, new = pool.add(path, int(threads) if threads else None, options)
+        return protocol.command(protocol.OK if new else protocol.DUP, str(job_id))
+    elif verb == protocol.STATUS:
+        status = pool.status()
+        status['remote'] = coordinator.status() if coordinator else []
+        return protocol.command(protocol.OK, json.dumps(status))
+    elif verb == protocol.WORKERS and arg.isdigit():
+        return protocol.command(protocol.OK, str(pool.resize(int(arg))))
+    # else
+    return protocol.command(protocol.ERR, 'unknown command: {0}'.format(verb))
+
+
+class Server(asyncore.dispatcher):
+    """
+    Accepts the client connections. Many clients can be connected at the same time.
+    """
+    def __init__(self, host, port):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            ClientHandler(sock)
+
+
+class RemoteWorker(asynchat.async_chat):
+    """
+    The connection of a remote worker (see worker.py and protocol.py).
+
+    The worker gets jobs as long as it has free cores. Its jobs are
+    leased to it; the leases are renewed by its heartbeats.
+    """
+    def __init__(self, sock, coordinator):
+        asynchat.async_chat.__init__(self, sock)
+        self.set_terminator(protocol.TERMINATOR)
+        self.coordinator = coordinator
+        self.data = []
+        self.size = 0
+        self.number = None      # given at registration
+        self.name = None
+        self.cores = 0
+        self.leases = {}        # job id -> (job, threads, expiry)
+        self.last_seen = time.time()
+        self.processed = 0
+
+    def collect_incoming_data(self, data):
+        self.data.append(data)
+        self.size += len(data)
+        if self.size > protocol.MAX_LINE:
+            self.handle_close()
+
+    def found_terminator(self):
+        line = ''.join(self.data)
+        self.data, self.size = [], 0
+        msg = protocol.parse_message(line)
+        if msg is None:
+            return
+        # else
+        self.last_seen = time.time()
+        kind = msg['type']
+        if kind == protocol.REGISTER and self.number is None:
+            self.name = str(msg.get('name', '?'))
+            self.cores = max(1, int(msg.get('cores', 1)))
+            self.number = self.coordinator.register(self)
+            self.push(protocol.message(protocol.REGISTERED, worker=self.number,
+                                       heartbeat=cfg.HEARTBEAT, lease=cfg.LEASE))
+        elif kind == protocol.HEARTBEAT:
+            expiry = time.time() + cfg.LEASE
+            for job_id in msg.get('jobs', []):
+                if job_id in self.leases:
+                    job, threads, _ = self.leases[job_id]
+                    self.leases[job_id] = (job, threads, expiry)
+        elif kind == protocol.DONE:
+            lease = self.leases.pop(msg.get('job'), None)
+            if lease:   # otherwise the lease has expired and the job was queued again
+                job = lease[0]
+                if msg.get('ok'):
+                    pool.q.done(job.id)
+                else:
+                    pool.q.failed(job.id)
+                self.processed += 1
+                job_finished('remote', bool(msg.get('ok')), msg.get('result') or {})
+                print "# {0} (remote worker {1}): {2}".format(job.path, self.name, 'done' if msg.get('ok') else 'failed')
+            self.coordinator.dispatch(self)
+
+    def cores_used(self):
+        return sum(threads for _, threads, _ in self.leases.values())
+
+    def assign(self, job):
+        threads = job.threads or THREADS
+        fields = dict(protocol.path_fields(job.path), job=job.id, threads=threads, options=job.options)
+        line = protocol.message(protocol.JOB, **fields)     # before the lease: it may raise
+        self.leases[job.id] = (job, threads, time.time() + cfg.LEASE)
+        job_started(job)
+        self.push(line)
+        print "# {0} -> remote worker {1} (job #{2})".format(job.path, self.name, job.id)
+
+    def expire(self, now):
+        """
+        Queue again the jobs whose lease has expired.
+        """
+        for job_id, (job, _, expiry) in self.leases.items():
+            if expiry < now:
+                del self.leases[job_id]
+                pool.q.requeue(job_id)
+                print "# lease of job #{0} expired (remote worker {1}), queued again".format(job_id, self.name)
+
+    def handle_close(self):
+        for job_id in self.leases:
+            pool.q.requeue(job_id)
+        if self.leases:
+            print "# remote worker {0} is gone, {1} job(s) queued again".format(self.name, len(self.leases))
+        self.leases = {}
+        self.coordinator.unregister(self)
+        self.close()
+
+    def status(self):
+        return {
+            'worker': 'r{0}'.format(self.number),
+            'name': self.name,
+            'cores': self.cores,
+            'cores_used': self.cores_used(),
+            'jobs': sorted(self.leases),
+            'last_seen': round(time.time() - self.last_seen, 1),
+            'processed': self.processed,
+        }
+
+
+class Coordinator(asyncore.dispatcher):
+    """
+    Hands the queued jobs to remote workers, next to the local worker pool.
+    """
+    def __init__(self, host, port):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.workers = []
+        self.next_number = 1
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            RemoteWorker(sock, self)
+
+    def register(self, worker):
+        number = self.next_number
+        self.next_number += 1
+        self.workers.append(worker)
+        print "# remote worker {0} ({1} cores) registered as r{2}".format(worker.name, worker.cores, number)
+        return number
+
+    def unregister(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+
+    def dispatch(self, worker):
+        """
+        Give jobs to a worker while it has free cores (an idle
+        worker takes any job).
+        """
+        while worker.connected and worker in self.workers:
+            used = worker.cores_used()
+            if used >= worker.cores:
+                return
+            # else
+            job = pool.q.get(timeout=0)
+            if job is None:
+                return
+            # else
+            if used > 0 and used + (job.threads or THREADS) > worker.cores:
+                pool.q.requeue(job.id)  # too big for the free cores
+                return
+            # else
+            try:
+                worker.assign(job)
+            except Exception:
+                traceback.print_exc()
+                pool.q.failed(job.id)   # not queued again: it would fail the same way
+
+    def tick(self):
+        """
+        Called from the event loop: expire the leases of silent workers
+        and hand out the new jobs.
+        """
+        now = time.time()
+        for worker in list(self.workers):
+            try:
+                if now - worker.last_seen > cfg.LEASE:
+                    print "# remote worker {0} is silent".format(worker.name)
+                    worker.handle_close()
+                    continue
+                # else
+                worker.expire(now)
+                self.dispatch(worker)
+            except Exception:
+                traceback.print_exc()   # the event loop goes on
 
-t = ProcessThread()
-t.start()
+    def status(self):
+        return [w.status() for w in self.workers]
 
 
-def process(value):
-    cmd = '{m2a} "{f}"'.format(m2a=cfg.M2A, f=value)
-    print '#', cmd
-    os.system(cmd)
+def watched(path):
+    """
+    Queue a new file of a watch folder.
+    """
+    job_id, new = pool.add(path)
+    if new:
+        print "# watch folder: {f} (job #{i})".format(f=path, i=job_id)
 
 
 def main():
-    s = socket.socket()         # Create a socket object
+    global watcher, coordinator, metrics_server
     host = socket.gethostname() # Get local machine name
     port = cfg.PORT                # Reserve a port for your service.
-    s.bind((host, port))        # Bind to the port
-    print "Listening on port {p}...".format(p=port)
-
-    s.listen(5)                 # Now wait for client connection.
-    while True:
-        try:
-            client, addr = s.accept()
-            ready = select.select([client,],[], [],2)
-            if ready[0]:
-                data = client.recv(4096)
-                #print data
-                t.add(data)
-        except KeyboardInterrupt:
-            print
-            print "Stop."
-            break
-        except socket.error, msg:
-            print "Socket error! %s" % msg
-            break
+    try:
+        Server(host, port)
+        print "Listening on port {p}...".format(p=port)
+        coordinator = Coordinator(host, cfg.WORKER_PORT)
+        print "Remote workers: port {p}".format(p=cfg.WORKER_PORT)
+        if cfg.METRICS_PORT:
+            metrics_server = metrics.MetricsServer(registry, cfg.METRICS_HOST, cfg.METRICS_PORT)
+            metrics_server.start()
+            print "Metrics: http://{h}:{p}/metrics".format(h=cfg.METRICS_HOST, p=cfg.METRICS_PORT)
+        if cfg.WATCH_DIRS:
+            watcher = Watcher(cfg.WATCH_DIRS, watched, cfg.WATCH_SETTLE, cfg.WATCH_POLL)
+            watcher.start()
+        while True:
+            asyncore.loop(timeout=1, count=1)
+            coordinator.tick()
+    except KeyboardInterrupt:
+        print
+        print "Stop."
+    except socket.error, msg:
+        print "Socket error! %s" % msg
     #
     cleanup()
 
 
 def cleanup():
-    t.stop()
-    t.join()
+    if watcher:
+        watcher.stop()
+    if metrics_server:
+        metrics_server.stop()
+    pool.stop()
 
 #############################################################################
 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Tests of the remote workers on localhost.
+
+    ./test_remote.py        (or: python -m unittest test_remote)
+
+A coordinator runs in this process (without local workers) and two
+worker.py processes connect to it. The jobs are dummy files that are
+converted with the ffmpeg stub of bench/stubs; their video info is put
+into the probe cache beforehand, so neither mplayer nor a real ffmpeg
+is needed. POSIX only (the jobs are killed by process group).
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import asyncore
+import tempfile
+import unittest
+from subprocess import Popen, STDOUT, check_output, CalledProcessError
+
+import config as cfg
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORKER = os.path.join(HERE, 'worker.py')
+STUB_FFMPEG = os.path.join(HERE, os.pardir, 'bench', 'stubs', 'ffmpeg')
+INFO = {'ID_VIDEO_FORMAT': 'XVID', 'ID_VIDEO_WIDTH': '720', 'ID_VIDEO_HEIGHT': '576', 'ID_VIDEO_FPS': '25.000',
+        'ID_AUDIO_FORMAT': '85', 'ID_AUDIO_RATE': '44100', 'ID_AUDIO_NCH': '2', 'ID_LENGTH': '60.0'}
+TIMEOUT = 30    # seconds to wait for anything
+
+# the server reads its config on import: a private queue and a short lease
+WORK_DIR = tempfile.mkdtemp(prefix='m2a-test-')
+cfg.QUEUE_DB = os.path.join(WORK_DIR, 'queue.sqlite')
+cfg.HEARTBEAT = 1
+cfg.LEASE = 3
+os.environ['XDG_CACHE_HOME'] = os.path.join(WORK_DIR, 'cache')
+os.environ['PATH'] = os.path.dirname(sys.executable) + os.pathsep + os.environ.get('PATH', '')    # for the stub
+
+import server
+import utils
+from jobqueue import DONE
+
+coordinator = None
+
+
+def setUpModule():
+    global coordinator
+    server.pool.stop()      # every job goes to the remote workers
+    coordinator = server.coordinator = server.Coordinator('127.0.0.1', 0)
+
+
+def tearDownModule():
+    coordinator.close()
+    server.pool.q.close()
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+def children(pid):
+    """
+    The pids of the child processes of a process.
+    """
+    try:
+        return [int(p) for p in check_output(['pgrep', '-P', str(pid)]).split()]
+    except CalledProcessError:
+        return []   # no children
+
+
+class RemoteWorkerTest(unittest.TestCase):
+    """
+    Two workers with one core each, connected to the coordinator.
+    """
+    delay = 0.5     # seconds per conversion
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(dir=WORK_DIR)
+        env = dict(os.environ, M2A_STUB_DELAY=str(self.delay))
+        port = coordinator.socket.getsockname()[1]
+        self.log = open(os.path.join(self.dir, 'workers.log'), 'wb')
+        self.processes = [Popen([sys.executable, WORKER, '127.0.0.1:{0}'.format(port), '-cores:1'],
+                                stdout=self.log, stderr=STDOUT, env=env, close_fds=True)
+                          for _ in range(2)]
+        self.run_until(lambda: len(coordinator.workers) == 2)
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        self.run_until(lambda: not coordinator.workers)
+        self.log.close()
+
+    def run_until(self, condition, timeout=TIMEOUT):
+        """
+        Run the event loop of the coordinator until condition() is true.
+        """
+        end = time.time() + timeout
+        while not condition():
+            if time.time() > end:
+                self.fail("timeout; the log of the workers: " + os.path.join(self.dir, 'workers.log'))
+            asyncore.loop(timeout=0.1, count=1)
+            coordinator.tick()
+
+    def add_jobs(self, n):
+        """
+        Queue n dummy movies, return their job ids.
+        """
+        cache = utils.get_probe_cache()
+        ids = []
+        for i in range(n):
+            path = os.path.join(self.dir, 'movie{0}.avi'.format(i))
+            with open(path, 'wb') as f:
+                f.write('\0' * 1024)
+            cache.put(cache.key(path), INFO)
+            job_id, _ = server.pool.add(path, 1, {'ffmpeg': STUB_FFMPEG, 'output_cache': 0})
+            ids.append(job_id)
+        return ids
+
+    def done(self, ids):
+        finished = set(job.id for job in server.pool.q.jobs(DONE))
+        return set(ids) <= finished
+
+    def leased(self, job_id):
+        """
+        The worker that holds the lease of a job, or None.
+        """
+        for worker in coordinator.workers:
+            if job_id in worker.leases:
+                return worker
+        return None
+
+
+class DispatchTest(RemoteWorkerTest):
+    def test_dispatch(self):
+        ids = self.add_jobs(4)
+        self.run_until(lambda: self.done(ids))
+        self.assertEqual(sorted(w.processed for w in coordinator.workers), [2, 2])
+        for i in range(4):
+            self.assertTrue(os.path.isfile(os.path.join(self.dir, 'movie{0}.mp4'.format(i))))
+
+
+class LeaseTest(RemoteWorkerTest):
+    delay = 2.5 * cfg.LEASE     # the conversion outlives the first lease
+
+    def test_heartbeat_renews_lease(self):
+        job_id = self.add_jobs(1)[0]
+        self.run_until(lambda: self.leased(job_id))
+        worker = self.leased(job_id)
+        job, _, first_expiry = worker.leases[job_id]
+        self.run_until(lambda: time.time() > first_expiry + cfg.HEARTBEAT)
+        self.assertIs(self.leased(job_id), worker)
+        self.assertIs(worker.leases[job_id][0], job)    # the same lease, not queued and handed out again
+        self.assertGreater(worker.leases[job_id][2], first_expiry)
+        self.run_until(lambda: self.done([job_id]))
+        self.assertEqual(sorted(w.processed for w in coordinator.workers), [0, 1])
+
+
+class RequeueTest(RemoteWorkerTest):
+    delay = 2
+
+    def test_requeue_after_kill(self):
+        ids = self.add_jobs(2)
+        self.run_until(lambda: all(self.leased(job_id) for job_id in ids))
+        victim = self.processes[0]
+        self.run_until(lambda: children(victim.pid))     # its job has started
+        jobs = children(victim.pid)
+        victim.kill()
+        victim.wait()
+        for pid in jobs:    # its conversion would race the one of the job queued again
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.run_until(lambda: len(coordinator.workers) == 1)
+        survivor = coordinator.workers[0]
+        self.run_until(lambda: self.done(ids))
+        self.assertEqual(survivor.processed, 2)     # its own job and the one of the dead worker
+
+
+if __name__ == '__main__':
+    unittest.main()
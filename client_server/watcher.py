@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Watch folders: new movies in the watched directories are queued automatically.
+
+The directories (and their subdirectories) are monitored with inotify
+(Linux). Where inotify is not available, the directories are polled,
+but only those whose modification time changed are listed again, so
+directories with many thousands of entries are not rescanned all the
+time.
+
+A new file is queued once it stopped growing: its size and modification
+time must stay the same for `settle` seconds (a copy or a download can
+take a while). Only files with a movie extension are taken; hidden files
+(e.g. the .part files of the running conversions) and the outputs of
+earlier conversions (see manifest.py) are ignored.
+
+Files that are already in the directories when the watcher starts are
+not queued.
+"""
+
+import os
+import sys
+import time
+import stat
+import errno
+import select
+import struct
+import traceback
+from threading import Thread
+
+import manifest
+
+EXTENSIONS = ('.avi', '.mkv', '.mp4', '.m4v', '.mov', '.mpg', '.mpeg', '.wmv', '.flv', '.webm', '.ts', '.vob')
+
+# inotify events (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x800
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+EVENT = struct.Struct('iIII')   # wd, mask, cookie, length of the name
+
+
+class Inotify(object):
+    """
+    A minimal ctypes binding of inotify. Raises OSError if it's not available.
+    """
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        name = ctypes.util.find_library('c')
+        if not name:
+            raise OSError(errno.ENOSYS, "libc not found")
+        # else
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+        # else
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.ctypes = ctypes
+        self.paths = {}     # watch descriptor -> directory
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), "cannot watch {0}".format(path))
+        self.paths[wd] = path
+        return wd
+
+    def read(self, timeout):
+        """
+        Wait at most timeout seconds for events.
+        Return a list of (directory, mask, name) triples.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        # else
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos+length].rstrip('\0')
+            pos += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)    # the directory was removed
+            elif wd in self.paths or mask & IN_Q_OVERFLOW:
+                events.append((self.paths.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(Thread):
+    """
+    Watches directories and calls callback(path) with each new movie
+    file once it stopped growing.
+    """
+    def __init__(self, directories, callback, settle=10, poll_interval=30, extensions=EXTENSIONS):
+        super(Watcher, self).__init__()
+        self.daemon = True
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.callback = callback
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.extensions = extensions
+        self.running = True
+        self.started = time.time()
+        self.pending = {}       # path -> (size, mtime, time of the last change)
+        self.snapshot = {}      # directory -> (mtime, set of names); used by polling
+
+    def stop(self):
+        self.running = False
+
+    def wanted(self, path):
+        name = os.path.basename(path)
+        return not name.startswith('.') and os.path.splitext(name)[1].lower() in self.extensions
+
+    def touch(self, path):
+        """
+        Something happened to path: (re)start its settle period.
+        """
+        if self.wanted(path):
+            self.pending[path] = None
+
+    def check_pending(self):
+        """
+        Hand over the files that didn't change for `settle` seconds.
+        Only the pending files are looked at. An error of the callback
+        is logged and the file is dropped.
+        """
+        now = time.time()
+        for path, last in self.pending.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]  # removed or renamed in the meantime
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                del self.pending[path]
+                continue
+            state = (st.st_size, st.st_mtime)
+            if last is None or last[:2] != state:
+                self.pending[path] = state + (now,)
+            elif now - last[2] >= self.settle:
+                del self.pending[path]
+                try:
+                    if not manifest.is_output(path):
+                        self.callback(path)
+                except Exception:
+                    # one bad file must not stop the watcher
+                    print >>sys.stderr, "# cannot queue {0!r}:".format(path)
+                    traceback.print_exc()
+
+    def walk(self, top):
+        """
+        The directories under top (top included).
+        """
+        for root, dirs, _ in os.walk(top):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            yield root
+
+    def run(self):
+        try:
+            self.watch()
+        except OSError as e:
+            print >>sys.stderr, "# inotify is not available ({0}), polling every {1} sec.".format(e, self.poll_interval)
+            self.poll()
+
+    def watch(self):
+        inotify = Inotify()
+        try:
+            for top in self.directories:
+                for d in self.walk(top):
+                    inotify.add_watch(d)
+            print "# watching {0} director(y/ies) with inotify".format(len(inotify.paths))
+            while self.running:
+                for directory, mask, name in inotify.read(1.0):
+                    if mask & IN_Q_OVERFLOW:
+                        self.rescan(inotify)
+                        continue
+                    # else
+                    path = os.path.join(directory, name)
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO) and not name.startswith('.'):
+                            self.add_directory(inotify, path)
+                    elif name:
+                        self.touch(path)
+                self.check_pending()
+        finally:
+            inotify.close()
+
+    def add_directory(self, inotify, top):
+        """
+        A directory was created or moved in: watch it and take its files.
+        """
+        for d in self.walk(top):
+            try:
+                inotify.add_watch(d)
+                for name in os.listdir(d):
+                    self.touch(os.path.join(d, name))
+            except OSError:
+                pass
+
+    def rescan(self, inotify):
+        """
+        Events were lost (the kernel's queue overflowed). Take the files
+        that changed since the watcher started.
+        """
+        print >>sys.stderr, "# inotify queue overflow, rescanning"
+        for d in set(inotify.paths.values()):
+            try:
+                for name in os.listdir(d):
+                    path = os.path.join(d, name)
+                    if os.path.isfile(path) and os.path.getmtime(path) >= self.started:
+                        self.touch(path)
+            except OSError:
+                pass
+
+    def poll(self):
+        for top in self.directories:
+            for d in self.walk(top):
+                self.scan(d, initial=True)
+        last = time.time()
+        while self.running:
+            time.sleep(1)
+            if time.time() - last >= self.poll_interval:
+                last = time.time()
+                for d in self.snapshot.keys():
+                    self.scan(d)
+            self.check_pending()
+
+    def scan(self, directory, initial=False):
+        """
+        List a directory again if its modification time changed and
+        take the new entries.
+        """
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            self.snapshot.pop(directory, None)
+            return
+        old = self.snapshot.get(directory)
+        if old and old[0] == mtime:
+            return
+        # else
+        try:
+            names = set(os.listdir(directory))
+        except OSError:
+            return
+        self.snapshot[directory] = (mtime, names)
+        if initial:
+            return
+        # else
+        for name in names - old[1] if old else names:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                if not name.startswith('.'):
+                    for d in self.walk(path):
+                        self.scan(d, initial=True)
+                        for sub in self.snapshot.get(d, (None, ()))[1]:
+                            self.touch(os.path.join(d, sub))
+            else:
+                self.touch(path)
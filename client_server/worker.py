@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""
+A remote worker of the conversion server.
+
+    ./worker.py [host[:port]] [-cores:<n>]
+
+It connects to the coordinator of the server (default: this machine,
+port WORKER_PORT of config.py), registers with its number of CPU cores
+and converts the jobs it receives (several at the same time if it has
+enough cores). The movie files must be reachable on the same path as on
+the server (e.g. a shared network drive).
+
+While it works, it sends a heartbeat every few seconds; if the worker
+dies, its jobs are queued again on the server. If the connection is
+lost, the worker stops its running conversions (the coordinator queues
+them again) and connects again.
+
+Each job is converted in a process of its own (./worker.py -job, in a
+new process group), so that it can be stopped together with its ffmpeg.
+
+Several workers can run on the same machine (e.g. to try it out).
+"""
+
+import config as cfg
+import protocol
+from threading import Thread, Lock
+from subprocess import Popen, PIPE
+import traceback
+import signal
+import socket
+import time
+import sys
+import os
+import re
+
+import bootstrap    # makes movie2android importable #@UnusedImport
+import movie2android
+import tracing
+import utils
+
+RECONNECT = 5   # seconds to wait before connecting again
+JOB_SWITCH = '-job'
+
+
+class Worker(object):
+    """
+    One connection to the coordinator.
+    """
+    def __init__(self, host, port, cores):
+        self.sock = socket.create_connection((host, port))
+        self.reader = self.sock.makefile('rb')
+        self.send_lock = Lock()
+        self.cores = cores
+        self.jobs = {}          # job id -> process of the conversion (None until it's started)
+        self.jobs_lock = Lock()
+        self.alive = True
+
+    def send(self, kind, **fields):
+        with self.send_lock:
+            self.sock.sendall(protocol.message(kind, **fields))
+
+    def receive(self):
+        """
+        The next message or None if the connection is closed.
+        """
+        while True:
+            line = self.reader.readline()
+            if not line:
+                return None
+            msg = protocol.parse_message(line.rstrip(protocol.TERMINATOR))
+            if msg is not None:
+                return msg
+
+    def heartbeat(self, interval):
+        while self.alive:
+            time.sleep(interval)
+            with self.jobs_lock:
+                jobs = sorted(self.jobs)
+            try:
+                self.send(protocol.HEARTBEAT, jobs=jobs)
+            except socket.error:
+                return
+
+    def convert(self, msg):
+        """
+        Convert a job in a process of its own (see run_job()) and report the result.
+        """
+        job_id = msg['job']
+        print '#', protocol.message_path(msg)
+        msg['jobs'] = max(1, self.cores // msg['threads'])
+        done = None
+        try:
+            with tracing.span('remote job', job=job_id, path=msg['path'], threads=msg['threads']):
+                process = Popen([sys.executable, os.path.abspath(__file__), JOB_SWITCH], stdin=PIPE, stdout=PIPE,
+                                close_fds=True, preexec_fn=getattr(os, 'setpgrp', None))
+                with self.jobs_lock:
+                    self.jobs[job_id] = process
+                    if not self.alive:
+                        stop(process)   # the connection was lost in the meantime
+                out = process.communicate(protocol.message(protocol.JOB, **msg))[0]
+            lines = out.splitlines()
+            done = protocol.parse_message(lines[-1]) if lines else None
+        except (OSError, ValueError):
+            traceback.print_exc()
+        with self.jobs_lock:
+            del self.jobs[job_id]
+        if not self.alive:
+            return      # the coordinator has queued the job again
+        # else
+        try:
+            self.send(protocol.DONE, job=job_id, ok=bool(done and done.get('ok')),
+                      result=done.get('result', {}) if done else {})
+        except socket.error:
+            pass    # the coordinator has queued the job again
+
+    def stop_jobs(self):
+        """
+        The connection is lost: stop the running conversions.
+        """
+        with self.jobs_lock:
+            self.alive = False
+            for process in self.jobs.values():
+                if process is not None:
+                    stop(process)
+
+    def run(self):
+        self.send(protocol.REGISTER, name=socket.gethostname(), cores=self.cores, pid=os.getpid())
+        msg = self.receive()
+        if not msg or msg['type'] != protocol.REGISTERED:
+            return
+        # else
+        print "Registered as worker r{0} ({1} cores).".format(msg['worker'], self.cores)
+        beat = Thread(target=self.heartbeat, args=(msg['heartbeat'],))
+        beat.daemon = True
+        beat.start()
+        try:
+            while True:
+                msg = self.receive()
+                if msg is None:
+                    break
+                if msg['type'] == protocol.JOB:
+                    thread = Thread(target=self.convert, args=(msg,))
+                    thread.daemon = True
+                    with self.jobs_lock:
+                        self.jobs[msg['job']] = None
+                    thread.start()
+        finally:
+            self.stop_jobs()
+            self.sock.close()
+
+
+def stop(process):
+    """
+    Kill a conversion process with its children (ffmpeg).
+    """
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGTERM)
+        else:
+            process.kill()
+    except OSError:
+        pass    # it has just finished
+
+
+def run_job():
+    """
+    The body of a job's process (./worker.py -job). The job message
+    is read from the standard input; the "done" message is the last
+    line of the standard output. Everything else (e.g. the progress of
+    ffmpeg) goes to the standard error.
+    """
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    msg = protocol.parse_message(sys.stdin.readline())
+    try:
+        options = dict((str(k), v) for k, v in msg.get('options', {}).items())
+        result = movie2android.convert(protocol.message_path(msg), threads=msg['threads'], jobs=msg['jobs'], **options)
+    except Exception:
+        traceback.print_exc()
+        result = None
+    out.write(protocol.message(protocol.DONE, job=msg['job'], ok=bool(result and result.status),
+                               result=protocol.result_fields(result)))
+    out.close()
+
+
+def main(args):
+    host, port = socket.gethostname(), cfg.WORKER_PORT
+    cores = utils.cpu_count()
+    for e in args:
+        m = re.search(r'^-cores:(\d+)$', e)
+        if m:
+            cores = max(1, int(m.group(1)))
+        else:
+            host, _, p = e.partition(':')
+            port = int(p) if p else port
+    #
+    while True:
+        try:
+            Worker(host, port, cores).run()
+            print "The connection to {0}:{1} was lost.".format(host, port)
+        except socket.error as e:
+            print "Cannot connect to {0}:{1} ({2}).".format(host, port, e)
+        time.sleep(RECONNECT)
+
+#############################################################################
+
+if __name__ == "__main__":
+    if sys.argv[1:] == [JOB_SWITCH]:
+        run_job()
+        sys.exit(0)
+    # else
+    try:
+        main(sys.argv[1:])
+    except KeyboardInterrupt:
+        print
+        print "Stop."
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+
+"""
+Read the basic properties of a video from its container header.
+
+Supported containers: MP4/MOV, AVI and Matroska (MKV/WebM). Only the
+header structures are read (with a few small seeks), no frame is decoded
+and no external process is started. The result has the same shape as the
+info returned by mplayer (see utils.get_video_info()), e.g.
+
+    {'ID_DEMUXER': 'mov', 'ID_LENGTH': '5412.04',
+     'ID_VIDEO_FORMAT': 'avc1', 'ID_VIDEO_WIDTH': '720', ...}
+
+For H.264 video the profile and the level are read from the decoder
+configuration (avcC) too: 'ID_VIDEO_PROFILE' (profile_idc, e.g. '66'
+for baseline), 'ID_VIDEO_CONSTRAINTS' (the constraint flags byte) and
+'ID_VIDEO_LEVEL' (e.g. '30' for level 3.0). mplayer doesn't report
+these keys.
+
+All values are strings. If the format is not supported or the header
+cannot be parsed, get_info() returns None and the caller should fall
+back to mplayer.
+"""
+
+import os
+import struct
+
+MAX_HEADER = 32 * 1024 * 1024   # refuse to read bigger header structures
+
+# MP4/MOV
+MP4_TOP_BOXES = ('ftyp', 'moov', 'mdat', 'free', 'skip', 'wide', 'pnot')
+MP4_CONTAINERS = ('moov', 'trak', 'mdia', 'minf', 'stbl')
+
+# Matroska element IDs
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_CODEC_PRIVATE = 0x63A2
+MKV_DEFAULT_DURATION = 0x23E383
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_AUDIO = 0xE1
+MKV_SAMPLING_FREQUENCY = 0xB5
+MKV_CHANNELS = 0x9F
+MKV_TRACK_VIDEO, MKV_TRACK_AUDIO = 1, 2
+
+# Matroska codec IDs -> format names used by mplayer
+MKV_CODECS = {
+    'V_MPEG4/ISO/AVC': 'avc1',
+    'V_MPEGH/ISO/HEVC': 'hvc1',
+    'V_MPEG4/ISO/ASP': 'FMP4',
+    'V_MPEG2': 'mpg2',
+    'V_VP8': 'VP80',
+    'V_VP9': 'VP90',
+    'A_AAC': 'MP4A',
+    'A_MPEG/L3': '85',
+    'A_AC3': '8192',
+    'A_DTS': '8193',
+    'A_VORBIS': 'vrbs',
+    'A_OPUS': 'opus',
+}
+
+
+class ParseError(Exception):
+    """
+    The header is damaged or uses a feature that is not supported.
+    """
+    pass
+
+
+def get_info(fname):
+    """
+    Get info about a video from its container header.
+
+    Return None if the container is not supported or its header
+    cannot be parsed. The returned dictionary always has an
+    'ID_LENGTH' key.
+    """
+    try:
+        with open(fname, 'rb') as f:
+            head = f.read(12)
+            if len(head) < 12:
+                return None
+            if head[:4] == 'RIFF' and head[8:12] == 'AVI ':
+                info = parse_avi(f)
+            elif head[:4] == struct.pack('>I', EBML_HEADER):
+                info = parse_mkv(f)
+            elif head[4:8] in MP4_TOP_BOXES:
+                info = parse_mp4(f)
+            else:
+                return None
+    except (IOError, OSError, ParseError, struct.error, IndexError):
+        return None
+    #
+    if not info or 'ID_LENGTH' not in info:
+        return None
+    return info
+
+
+def file_size(f):
+    f.seek(0, os.SEEK_END)
+    return f.tell()
+
+
+def read_at(f, pos, size):
+    """
+    Read exactly size bytes from position pos.
+    """
+    if size < 0:
+        raise ParseError("negative header size")
+    if size > MAX_HEADER:
+        raise ParseError("header structure too big")
+    f.seek(pos)
+    data = f.read(size)
+    if len(data) != size:
+        raise ParseError("unexpected end of file")
+    return data
+
+
+def fmt_length(seconds):
+    return "{0:.2f}".format(seconds)
+
+#############################################################################
+##  MP4 / MOV  ##############################################################
+#############################################################################
+
+def avc_config(data, start, end, info):
+    """
+    Profile and level of H.264 video from an AVCDecoderConfigurationRecord.
+    """
+    if end - start >= 4 and ord(data[start]) == 1:
+        info['ID_VIDEO_PROFILE'] = str(ord(data[start+1]))
+        info['ID_VIDEO_CONSTRAINTS'] = str(ord(data[start+2]))
+        info['ID_VIDEO_LEVEL'] = str(ord(data[start+3]))
+
+
+def mp4_boxes(data, start, end):
+    """
+    Iterate over the boxes of data[start:end].
+
+    Yield (type, payload start, payload end) triples.
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[pos:pos+8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[pos+8:pos+16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ParseError("invalid box size")
+        yield kind, pos + header, min(pos + size, end)
+        pos += size
+
+
+def find_moov(f):
+    """
+    Walk the top-level boxes (seeking over 'mdat') and return
+    the payload of the 'moov' box or None.
+    """
+    end = file_size(f)
+    pos = 0
+    while pos + 8 <= end:
+        header = read_at(f, pos, min(16, end - pos))
+        size, kind = struct.unpack('>I4s', header[:8])
+        length = 8
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+            length = 16
+        elif size == 0:
+            size = end - pos
+        if size < length:
+            raise ParseError("invalid box size")
+        if kind == 'moov':
+            return read_at(f, pos + length, min(size, end - pos) - length)
+        pos += size
+    return None
+
+
+def mp4_time(data, pos):
+    """
+    (timescale, duration) of an 'mvhd' or 'mdhd' box starting at pos.
+    """
+    if ord(data[pos]) == 1:
+        return struct.unpack('>IQ', data[pos+20:pos+32])
+    # else
+    return struct.unpack('>II', data[pos+12:pos+20])
+
+
+def mp4_collect(data, start, end, boxes):
+    """
+    Collect the first occurrence of each box in a track.
+    The value is a (payload start, payload end) pair.
+    """
+    for kind, payload, box_end in mp4_boxes(data, start, end):
+        boxes.setdefault(kind, (payload, box_end))
+        if kind in MP4_CONTAINERS:
+            mp4_collect(data, payload, box_end, boxes)
+
+
+def mp4_track(data, start, end, info):
+    boxes = {}
+    mp4_collect(data, start, end, boxes)
+    if 'hdlr' not in boxes or 'stsd' not in boxes:
+        return
+    handler = data[boxes['hdlr'][0]+8:boxes['hdlr'][0]+12]
+    entry = boxes['stsd'][0] + 8     # version, flags, entry count
+    fourcc = data[entry+4:entry+8]
+    #
+    if handler == 'vide' and 'ID_VIDEO_FORMAT' not in info:
+        info['ID_VIDEO_FORMAT'] = fourcc
+        width, height = struct.unpack('>HH', data[entry+32:entry+36])
+        if 'tkhd' in boxes:
+            # the display size (16.16 fixed point) is at the end of tkhd
+            tkhd_end = boxes['tkhd'][1]
+            w, h = struct.unpack('>II', data[tkhd_end-8:tkhd_end])
+            if w and h:
+                width, height = w >> 16, h >> 16
+        info['ID_VIDEO_WIDTH'] = str(width)
+        info['ID_VIDEO_HEIGHT'] = str(height)
+        # the boxes of the visual sample entry start after its 86 byte header
+        entry_end = min(entry + struct.unpack('>I', data[entry:entry+4])[0], boxes['stsd'][1])
+        for kind, payload, box_end in mp4_boxes(data, entry + 86, entry_end):
+            if kind == 'avcC':
+                avc_config(data, payload, box_end, info)
+        if 'mdhd' in boxes and 'stts' in boxes:
+            timescale, duration = mp4_time(data, boxes['mdhd'][0])
+            pos = boxes['stts'][0] + 4
+            count = struct.unpack('>I', data[pos:pos+4])[0]
+            frames = 0
+            for i in xrange(count):
+                frames += struct.unpack('>I', data[pos+4+8*i:pos+8+8*i])[0]
+            if timescale and duration:
+                info['ID_VIDEO_FPS'] = "{0:.3f}".format(frames * float(timescale) / duration)
+    elif handler == 'soun' and 'ID_AUDIO_FORMAT' not in info:
+        info['ID_AUDIO_FORMAT'] = fourcc
+        info['ID_AUDIO_NCH'] = str(struct.unpack('>H', data[entry+24:entry+26])[0])
+        info['ID_AUDIO_RATE'] = str(struct.unpack('>I', data[entry+32:entry+36])[0] >> 16)
+
+
+def parse_mp4(f):
+    moov = find_moov(f)
+    if moov is None:
+        return None
+    # else
+    info = {'ID_DEMUXER': 'mov'}
+    for kind, start, end in mp4_boxes(moov, 0, len(moov)):
+        if kind == 'mvhd':
+            timescale, duration = mp4_time(moov, start)
+            if timescale and duration:
+                info['ID_LENGTH'] = fmt_length(float(duration) / timescale)
+        elif kind == 'trak':
+            mp4_track(moov, start, end, info)
+    return info
+
+#############################################################################
+##  AVI  ####################################################################
+#############################################################################
+
+def avi_chunks(data, start, end):
+    """
+    Iterate over the RIFF chunks of data[start:end].
+
+    Yield (id, payload start, payload end) triples.
+    """
+    pos = start
+    while pos + 8 <= end:
+        chunk_id, size = struct.unpack('<4sI', data[pos:pos+8])
+        yield chunk_id, pos + 8, min(pos + 8 + size, end)
+        pos += 8 + size + (size & 1)    # chunks are padded to even size
+
+
+def avi_stream(data, start, end, info, streams):
+    header = None
+    for chunk_id, payload, chunk_end in avi_chunks(data, start, end):
+        if chunk_id == 'strh':
+            header = data[payload:chunk_end]
+        elif chunk_id == 'strf' and header is not None:
+            kind = header[0:4]
+            scale, rate, _, length = struct.unpack('<IIII', header[20:36])
+            if kind == 'vids' and 'video' not in streams:
+                streams['video'] = (scale, rate, length)
+                width, height = struct.unpack('<Ii', data[payload+4:payload+12])
+                info['ID_VIDEO_FORMAT'] = data[payload+16:payload+20]
+                info['ID_VIDEO_WIDTH'] = str(width)
+                info['ID_VIDEO_HEIGHT'] = str(abs(height))
+                if scale:
+                    info['ID_VIDEO_FPS'] = "{0:.3f}".format(float(rate) / scale)
+            elif kind == 'auds' and 'ID_AUDIO_FORMAT' not in info:
+                tag, channels, sample_rate = struct.unpack('<HHI', data[payload:payload+8])
+                info['ID_AUDIO_FORMAT'] = str(tag)
+                info['ID_AUDIO_NCH'] = str(channels)
+                info['ID_AUDIO_RATE'] = str(sample_rate)
+
+
+def parse_avi(f):
+    chunk_id, size, list_type = struct.unpack('<4sI4s', read_at(f, 12, 12))
+    if chunk_id != 'LIST' or list_type != 'hdrl':
+        raise ParseError("missing AVI header list")
+    data = read_at(f, 24, size - 4)
+    #
+    info = {'ID_DEMUXER': 'avi'}
+    streams = {}
+    avih = None
+    odml_frames = None
+    for chunk_id, payload, end in avi_chunks(data, 0, len(data)):
+        if chunk_id == 'avih':
+            avih = struct.unpack('<IIIII', data[payload:payload+20])
+        elif chunk_id == 'LIST':
+            list_type = data[payload:payload+4]
+            if list_type == 'strl':
+                avi_stream(data, payload + 4, end, info, streams)
+            elif list_type == 'odml':
+                for sub_id, sub_payload, _ in avi_chunks(data, payload + 4, end):
+                    if sub_id == 'dmlh':
+                        odml_frames = struct.unpack('<I', data[sub_payload:sub_payload+4])[0]
+    #
+    if 'video' in streams:
+        scale, rate, length = streams['video']
+        if odml_frames:
+            length = odml_frames    # OpenDML (>1 GB) files
+        if rate:
+            info['ID_LENGTH'] = fmt_length(float(length) * scale / rate)
+    elif avih and avih[0]:
+        usec_per_frame, total_frames = avih[0], avih[4]
+        info['ID_LENGTH'] = fmt_length(total_frames * usec_per_frame / 1e6)
+    return info
+
+#############################################################################
+##  Matroska  ###############################################################
+#############################################################################
+
+def read_vint(data, pos, keep_marker=False):
+    """
+    Read an EBML variable size integer from data[pos:].
+
+    Return (value, length). For sizes, value is None if the size is unknown.
+    """
+    first = ord(data[pos])
+    mask = 0x80
+    length = 1
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ParseError("invalid EBML integer")
+    if pos + length > len(data):
+        raise ParseError("truncated EBML integer")
+    value = first if keep_marker else first & (mask - 1)
+    for c in data[pos+1:pos+length]:
+        value = (value << 8) | ord(c)
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, length
+
+
+def ebml_element(data, pos):
+    """
+    Read an element header. Return (id, size, header length).
+    """
+    eid, id_length = read_vint(data, pos, keep_marker=True)
+    size, size_length = read_vint(data, pos + id_length)
+    return eid, size, id_length + size_length
+
+
+def ebml_children(data, start, end):
+    """
+    Iterate over the child elements of data[start:end].
+
+    Yield (id, payload start, payload end) triples.
+    """
+    pos = start
+    while pos < end:
+        eid, size, length = ebml_element(data, pos)
+        if size is None:
+            raise ParseError("unknown element size")
+        yield eid, pos + length, min(pos + length + size, end)
+        pos += length + size
+
+
+def ebml_uint(data, start, end):
+    value = 0
+    for c in data[start:end]:
+        value = (value << 8) | ord(c)
+    return value
+
+
+def ebml_float(data, start, end):
+    if end - start == 4:
+        return struct.unpack('>f', data[start:end])[0]
+    elif end - start == 8:
+        return struct.unpack('>d', data[start:end])[0]
+    return 0.0
+
+
+def mkv_segment_info(data, info):
+    scale = 1000000     # default: 1 ms
+    duration = None
+    for eid, start, end in ebml_children(data, 0, len(data)):
+        if eid == MKV_TIMECODE_SCALE:
+            scale = ebml_uint(data, start, end)
+        elif eid == MKV_DURATION:
+            duration = ebml_float(data, start, end)
+    if duration:
+        info['ID_LENGTH'] = fmt_length(duration * scale / 1e9)
+
+
+def mkv_tracks(data, info):
+    for eid, start, end in ebml_children(data, 0, len(data)):
+        if eid != MKV_TRACK_ENTRY:
+            continue
+        # else
+        track = {}
+        for sub, sub_start, sub_end in ebml_children(data, start, end):
+            if sub in (MKV_VIDEO, MKV_AUDIO):
+                for prop, prop_start, prop_end in ebml_children(data, sub_start, sub_end):
+                    track[prop] = (prop_start, prop_end)
+            else:
+                track[sub] = (sub_start, sub_end)
+        if MKV_TRACK_TYPE not in track or MKV_CODEC_ID not in track:
+            continue
+        # else
+        kind = ebml_uint(data, *track[MKV_TRACK_TYPE])
+        codec = data[slice(*track[MKV_CODEC_ID])].rstrip('\x00')
+        codec = MKV_CODECS.get(codec, codec)
+        if kind == MKV_TRACK_VIDEO and 'ID_VIDEO_FORMAT' not in info:
+            info['ID_VIDEO_FORMAT'] = codec
+            if MKV_PIXEL_WIDTH in track and MKV_PIXEL_HEIGHT in track:
+                info['ID_VIDEO_WIDTH'] = str(ebml_uint(data, *track[MKV_PIXEL_WIDTH]))
+                info['ID_VIDEO_HEIGHT'] = str(ebml_uint(data, *track[MKV_PIXEL_HEIGHT]))
+            if MKV_DEFAULT_DURATION in track:
+                frame_ns = ebml_uint(data, *track[MKV_DEFAULT_DURATION])
+                if frame_ns:
+                    info['ID_VIDEO_FPS'] = "{0:.3f}".format(1e9 / frame_ns)
+            if codec == 'avc1' and MKV_CODEC_PRIVATE in track:
+                avc_config(data, track[MKV_CODEC_PRIVATE][0], track[MKV_CODEC_PRIVATE][1], info)
+        elif kind == MKV_TRACK_AUDIO and 'ID_AUDIO_FORMAT' not in info:
+            info['ID_AUDIO_FORMAT'] = codec
+            if MKV_SAMPLING_FREQUENCY in track:
+                info['ID_AUDIO_RATE'] = str(int(ebml_float(data, *track[MKV_SAMPLING_FREQUENCY])))
+            info['ID_AUDIO_NCH'] = str(ebml_uint(data, *track[MKV_CHANNELS])) \
+                if MKV_CHANNELS in track else '1'
+
+
+def read_element_header(f, pos, end):
+    return ebml_element(read_at(f, pos, min(12, end - pos)), 0)
+
+
+def parse_mkv(f):
+    end = file_size(f)
+    eid, size, length = read_element_header(f, 0, end)
+    if eid != EBML_HEADER or size is None:
+        raise ParseError("missing EBML header")
+    pos = length + size
+    eid, size, length = read_element_header(f, pos, end)
+    if eid != MKV_SEGMENT:
+        raise ParseError("missing Segment")
+    pos += length
+    if size is not None:
+        end = min(end, pos + size)
+    #
+    info = {'ID_DEMUXER': 'mkv'}
+    found = set()
+    # Info and Tracks are normally before the first Cluster
+    while pos < end and len(found) < 2:
+        eid, size, length = read_element_header(f, pos, end)
+        if size is None:
+            break   # e.g. a live stream's Cluster; cannot be skipped
+        if eid == MKV_INFO:
+            mkv_segment_info(read_at(f, pos + length, size), info)
+            found.add(eid)
+        elif eid == MKV_TRACKS:
+            mkv_tracks(read_at(f, pos + length, size), info)
+            found.add(eid)
+        pos += length + size
+    return info
+
+#############################################################################
+
+if __name__ == "__main__":
+    import sys
+    for fname in sys.argv[1:]:
+        print fname, get_info(fname)
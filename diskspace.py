@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Disk space admission of the encodes.
+
+The size of an output is predictable: -b:v 600k and -b:a 128k give
+about 5.5 MB per minute of video. Before an encode starts, its output is
+estimated from the length of the video and the bitrates (plus a margin),
+and it's admitted only if the file system of the output can hold it:
+
+    free space (statvfs) - space still needed by the running encodes
+                         - config['min_free']  >=  estimate
+
+The running encodes of the process reserve their estimates; the part of
+an output that is already written is not counted twice.
+
+If an encode doesn't fit, but it would fit without the reservations of
+the running encodes, it's deferred until one of them finishes (their
+estimates include a margin, so they usually leave more space than they
+reserved), then it's checked again. Otherwise it's rejected right away,
+instead of filling up the disk near the end of an hour-long encode.
+"""
+
+import os
+import re
+from threading import Condition
+
+MARGIN = 1.10               # the estimate is this much bigger than bitrate x length
+OVERHEAD = 1024 * 1024      # container overhead of an output (bytes)
+
+_cond = Condition()
+_reservations = []          # the Reservations of the running encodes
+
+
+def parse_bitrate(rate):
+    """
+    Bits per second of an ffmpeg bitrate, e.g. '600k' -> 600000.
+    """
+    m = re.search(r'^(\d+(?:\.\d+)?)([kKmM]?)$', rate.strip())
+    if not m:
+        raise ValueError("invalid bitrate: {0}".format(rate))
+    # else
+    return float(m.group(1)) * {'': 1, 'k': 1000, 'm': 1000 * 1000}[m.group(2).lower()]
+
+
+def estimate(length, bitrates):
+    """
+    Estimated size (bytes) of an output of `length` seconds encoded with
+    the given bitrates (e.g. ['600k', '128k']).
+    """
+    bits = sum(parse_bitrate(rate) for rate in bitrates) * length
+    return int(bits / 8 * MARGIN) + OVERHEAD
+
+
+def free_bytes(directory):
+    """
+    Free space for unprivileged users on the file system of directory.
+    None if it cannot be determined (e.g. no statvfs on this platform).
+    """
+    try:
+        st = os.statvfs(directory)
+    except (AttributeError, OSError):
+        return None
+    return st.f_bavail * st.f_frsize
+
+
+def device(directory):
+    try:
+        return os.stat(directory).st_dev
+    except OSError:
+        return None
+
+
+class Reservation(object):
+    """
+    The space reserved by an encode. Release it when the encode is done.
+    """
+    def __init__(self, directory, parts, nbytes):
+        self.device = device(directory)
+        self.parts = parts          # the files that are being written
+        self.nbytes = nbytes
+
+    def remaining(self):
+        """
+        Reserved bytes that are not written yet.
+        """
+        written = 0
+        for part in self.parts:
+            try:
+                written += os.path.getsize(part)
+            except OSError:
+                pass
+        return max(0, self.nbytes - written)
+
+    def release(self):
+        with _cond:
+            if self in _reservations:
+                _reservations.remove(self)
+                _cond.notify_all()
+
+
+def reserved(dev):
+    """
+    Space still needed by the running encodes on a file system. Call it with the lock held.
+    """
+    return sum(r.remaining() for r in _reservations if r.device == dev)
+
+
+def admit(directory, parts, nbytes, min_free=0, on_defer=None):
+    """
+    Wait until an encode of nbytes can be written into directory (parts
+    are its temporary outputs). Return a Reservation, or None if the
+    encode is rejected. Also returns a Reservation if the free space
+    cannot be determined.
+
+    on_defer() is called (once) if the encode has to wait.
+    """
+    reservation = Reservation(directory, parts, nbytes)
+    deferred = False
+    with _cond:
+        while True:
+            free = free_bytes(directory)
+            if free is None:
+                break
+            # else
+            free -= min_free
+            if nbytes <= free - reserved(reservation.device):
+                break
+            # else
+            running = any(r.device == reservation.device for r in _reservations)
+            if not running or nbytes > free:
+                return None
+            # else
+            if not deferred and on_defer:
+                on_defer()
+            deferred = True
+            _cond.wait(5)     # until a running encode is done (or the disk got emptier)
+        _reservations.append(reservation)
+    return reservation
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+"""
+Completion manifest of the conversions in a directory.
+
+When a file is converted successfully, a JSON line is appended to the
+manifest (.movie2android.jsonl) in the directory of the output:
+
+    {"input": "movie.avi", "size": 734003200, "mtime": 1372150923.0,
+     "settings": "9c1185a5c5e9fc54612808977ee8f548", "output": "movie.mp4",
+     "output_size": 104857600, "date": 1372160011.5}
+
+A re-run of the same batch skips the files whose entry matches the
+input (size and modification time), the settings and the output (it
+still exists with the recorded size). An input can have several outputs
+(e.g. one per device profile); the last entry of an (input, output) pair
+wins. The superseded lines are dropped when the manifest gets too long.
+
+The parsed manifest of a directory is kept in memory and read again
+only if the file changed (e.g. another process appended to it), so a
+batch of many files in one directory doesn't parse it for each file.
+
+The names are stored as unicode (decoded with the file system
+encoding). The bytes of a name that cannot be decoded are replaced, so
+such an input is converted again by the next run.
+
+Outputs are written under a temporary name and renamed when the
+conversion succeeded, so an output never exists half-written.
+"""
+
+import os
+import sys
+import json
+import codecs
+import time
+from threading import Lock
+from collections import OrderedDict
+
+MANIFEST = '.movie2android.jsonl'
+COMPACT_RATIO = 4       # rewrite the manifest if it has this many times more lines than inputs
+CACHED_DIRECTORIES = 64 # the parsed manifests of this many directories are kept in memory
+
+# the encoding of the file names; without a locale (LANG=C) they are taken as UTF-8
+ENCODING = sys.getfilesystemencoding() or 'utf-8'
+if codecs.lookup(ENCODING).name == 'ascii':
+    ENCODING = 'utf-8'
+
+_lock = Lock()
+_manifests = OrderedDict()  # directory -> Manifest
+
+
+def text(name):
+    """
+    A file name as it's stored in the manifest (unicode).
+    """
+    if isinstance(name, unicode):
+        return name
+    # else
+    return name.decode(ENCODING, 'replace')
+
+
+def file_name(name, like):
+    """
+    A name of the manifest in the type of `like` (bytes if it's a byte string).
+    """
+    if isinstance(like, unicode):
+        return name
+    # else
+    return name.encode(ENCODING)
+
+
+def get_manifest_file(directory):
+    return os.path.join(directory or '.', MANIFEST)
+
+
+def fingerprint(fname):
+    """
+    (size, modification time) of a file. Raises OSError if the file doesn't exist.
+    """
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime
+
+
+class Manifest(object):
+    """
+    The parsed manifest of a directory, indexed by input name.
+    """
+    def __init__(self):
+        self.entries = {}       # (input name, output name) -> last entry
+        self.inputs = {}        # input name -> {output name: last entry}
+        self.outputs = set()    # the output names
+        self.lines = 0
+        self.stamp = None       # (size, mtime, inode) of the file when it was read
+
+    def add(self, entry):
+        self.entries[(entry['input'], entry['output'])] = entry
+        self.inputs.setdefault(entry['input'], {})[entry['output']] = entry
+        self.outputs.add(entry['output'])
+
+
+def stamp(path):
+    """
+    (size, modification time, inode) of a manifest; None if it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime, st.st_ino
+
+
+def load(directory):
+    """
+    Read the manifest of a directory (a Manifest). A missing or
+    unreadable manifest is empty.
+    """
+    manifest = Manifest()
+    path = get_manifest_file(directory)
+    manifest.stamp = stamp(path)
+    try:
+        with open(path) as f:
+            for line in f:
+                manifest.lines += 1
+                try:
+                    manifest.add(json.loads(line))
+                except (ValueError, KeyError, TypeError):
+                    pass    # e.g. a line cut short by a crash
+    except IOError:
+        pass
+    return manifest
+
+
+def parsed(directory):
+    """
+    The Manifest of a directory. It's read again only if the file
+    changed (e.g. another process appended to it). Call it with the
+    lock held.
+    """
+    manifest = _manifests.pop(directory, None)
+    if manifest is None or manifest.stamp != stamp(get_manifest_file(directory)):
+        manifest = load(directory)
+    _manifests[directory] = manifest    # the most recently used is the last
+    while len(_manifests) > CACHED_DIRECTORIES:
+        _manifests.popitem(last=False)
+    return manifest
+
+
+def entries_of(fname):
+    """
+    The entries of an input, newest first.
+    """
+    directory, name = os.path.split(os.path.abspath(fname))
+    name = text(name)
+    with _lock:
+        entries = parsed(directory).inputs.get(name, {}).values()
+    return sorted(entries, key=lambda e: e.get('date'), reverse=True)
+
+
+def lookup(fname, settings):
+    """
+    The output of fname if it was already converted with these settings
+    and the output is intact, otherwise None.
+    """
+    try:
+        size, mtime = fingerprint(fname)
+    except OSError:
+        return None
+    # else
+    for entry in entries_of(fname):
+        try:
+            output = os.path.join(os.path.dirname(fname), file_name(entry['output'], fname))
+            if (entry['size'], entry['mtime'], entry['settings']) == (size, mtime, settings) and \
+                    os.path.getsize(output) == entry['output_size']:
+                return output
+        except (OSError, KeyError, UnicodeError):
+            pass
+    return None
+
+
+def recorded_output(fname, output):
+    """
+    Was output produced from fname (with any settings)? Such a file
+    may be overwritten by the next conversion of fname.
+    """
+    name = text(os.path.basename(output))
+    return any(entry.get('output') == name for entry in entries_of(fname))
+
+
+def is_output(fname):
+    """
+    Is fname the recorded output of a conversion?
+    """
+    directory, name = os.path.split(os.path.abspath(fname))
+    name = text(name)
+    with _lock:
+        return name in parsed(directory).outputs
+
+
+def record(fname, settings, output):
+    """
+    Append the entry of a successful conversion to the manifest.
+
+    Errors (e.g. a read-only directory) are ignored: the conversion is
+    done, only it won't be skipped next time.
+    """
+    directory, name = os.path.split(os.path.abspath(fname))
+    try:
+        size, mtime = fingerprint(fname)
+        entry = {'input': text(name), 'size': size, 'mtime': mtime, 'settings': settings,
+                 'output': text(os.path.basename(output)), 'output_size': os.path.getsize(output),
+                 'date': time.time()}
+    except OSError:
+        return
+    # else
+    path = get_manifest_file(directory)
+    with _lock:
+        try:
+            manifest = parsed(directory)
+            line = json.dumps(entry, sort_keys=True) + '\n'
+            with open(path, 'a') as f:
+                f.write(line)
+            manifest.add(entry)
+            manifest.lines += 1
+            before = manifest.stamp[0] if manifest.stamp else 0
+            manifest.stamp = stamp(path)
+            if manifest.stamp and manifest.stamp[0] != before + len(line):
+                manifest.stamp = None   # another process wrote too: read it again next time
+            compact(directory, manifest)
+        except (IOError, OSError, ValueError, UnicodeError):
+            pass
+
+
+def compact(directory, manifest):
+    """
+    Drop the superseded lines if there are too many of them.
+    The manifest is replaced atomically. Call it with the lock held.
+    """
+    if manifest.lines <= COMPACT_RATIO * max(len(manifest.entries), 10):
+        return
+    # else
+    path = get_manifest_file(directory)
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        for entry in sorted(manifest.entries.values(), key=lambda e: e.get('date')):
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    os.rename(tmp, path)
+    manifest.lines = len(manifest.entries)
+    manifest.stamp = stamp(path) if manifest.stamp else None
+
+
+def part_file(output):
+    """
+    Temporary name of an output while it's being written.
+    """
+    directory, name = os.path.split(output)
+    return os.path.join(directory, '.' + name + '.part')
@@ -42,6 +42,62 @@ will be processed one by one in a queue.
 Accepted switches:
 
     -threads:<n>            default: -threads:2
+    -jobs:<n>               default: -jobs:1
+    -segments:<n>           default: -segments:1
+    -profile:<name>         device profile, e.g. -profile:tablet (see profiles.py)
+    -profiles:<a>,<b>,...   one output per device profile, e.g. -profiles:phone,tablet
+    -speed:<tier>           default: -speed:balanced (see SPEED_TIERS)
+    -tune:<tune>            libx264 tune, e.g. -tune:film or -tune:animation
+    -copy:<0|1>             default: -copy:1 (copy the streams that fit the target)
+    -report:<file>          write a record per finished file (.csv or JSON lines, see report.py)
+    -table:<0|1>            default: -table:1 (show the summary table at the end)
+    -trace:<file>           record a timeline of the run (see tracing.py)
+    -order:<order>          default: -order:auto (auto, input, longest or shortest; see scheduler.py)
+    -h, --help              show this help
+
+The subcommand `benchmark [clip]` encodes a reference clip with each
+speed tier and reports the encoding speed and the output size
+(see benchmark.py).
+
+The subcommand `calibrate [clip]` runs short test encodes with several
+combinations of threads per job and parallel jobs, and saves the one
+with the highest total throughput for this machine (see calibrate.py).
+Afterwards it's the default of -threads and -jobs here and in the
+conversion server.
+
+With -jobs:<n> (n > 1), n files are converted at the same time. If
+-threads is not given (neither by a profile), the CPU cores are split
+evenly among the jobs. The longest files are started first, so the
+batch isn't held up by a long movie at the end (see -order).
+
+With -segments:<n> (n > 1), a long movie (see config['segment_min_length'])
+is cut into parts at keyframes, the parts are encoded by n ffmpeg processes
+at the same time, then they are joined without re-encoding.
+
+Streams that already fit the target are copied as they are: H.264
+baseline video (level <= 3.0) that isn't bigger than width x height
+and AAC audio, read from an MP4/MOV or MKV header. The other streams
+are encoded. Thus an input that fits the target is only remuxed into
+MP4. If the remux fails, the file is encoded the usual way.
+
+An output is written under a temporary name and renamed when it's
+complete. The finished conversions of a directory are recorded in a
+manifest (see manifest.py), thus an interrupted batch can be simply
+restarted: files that were converted with the same settings are skipped,
+the others (new, changed, partial or stale) are converted again.
+
+The outputs are also kept in a content-addressed cache (see outputcache.py),
+so the same movie in another directory is not encoded again.
+
+With -profiles:<a>,<b>,... a movie is converted for several devices at
+once: it's decoded only once, the frames are split, scaled and encoded by
+the same ffmpeg process, and the output of each profile is called
+`movie-<profile>.mp4`.
+
+It can also be used as a module (importing it has no side effects):
+
+    import movie2android
+    result = movie2android.convert('movie.avi', threads=4)
 """
 
 __author__ = "Laszlo Szathmary (jabba.laci@gmail.com)"
@@ -52,10 +108,15 @@ __license__ = "GPL"
 
 import os
 import sys
-import termcolor
 import re
-from texttable import Texttable
+from threading import Lock
 import utils
+import profiles
+import progress
+import manifest
+import tracing
+import scheduler
+import diskspace
 
 STATIC_BUILD, OWN_COMPILATION = range(2)    # enum
 FAILED = "failed"
@@ -71,6 +132,17 @@ config = {
     'width': '480',
     'height': '320',
     'threads': '2',
+    'jobs': '1',                                # number of parallel encodes
+    'segments': '1',                            # parallel parts of a long movie
+    'segment_min_length': '600',                # in seconds
+    'speed': 'balanced',                        # see SPEED_TIERS
+    'tune': '',                                 # libx264 tune, e.g. film or animation
+    'copy': '1',                                # copy the streams that fit the target
+    'output_cache': '10240',                    # size limit of the output cache in MB (0: off)
+    'report': '',                               # run report file, .csv or JSON lines (see report.py)
+    'table': '1',                               # show the summary table at the end
+    'order': 'auto',                            # order of the jobs, see scheduler.py
+    'min_free': '100',                          # MB to keep free on the disk of the outputs (see diskspace.py)
     'audio_codec': 'aac -strict experimental',
     'audio_codec_failsafe': 'libvo_aacenc',     # if the previous fails
 }
@@ -80,44 +152,150 @@ if VERSION == OWN_COMPILATION:
     config['audio_codec'] = 'libfdk_aac'
     config['audio_codec_failsafe'] = 'libfaac'
 
-FINGERPRINT = utils.get_short_fingerprint()
-if FINGERPRINT == 'a804db':
-    # on my home desktop I want this to be the default
-    config['threads'] = 4
+# speed/quality tiers -> libx264 presets (fastest first);
+# a slower preset gives a smaller file at the same quality
+SPEED_TIERS = [
+    ('fastest', 'ultrafast'),
+    ('fast', 'veryfast'),
+    ('balanced', 'medium'),
+    ('small', 'slow'),
+    ('smallest', 'veryslow'),
+]
+
+def x264_options(conf):
+    """
+    libx264 options of the selected speed tier and tune.
+    Raises ValueError if the speed tier is unknown.
+    """
+    presets = dict(SPEED_TIERS)
+    if conf['speed'] not in presets:
+        raise ValueError("unknown speed tier: {0} (available: {1})".format(
+            conf['speed'], ', '.join(name for name, _ in SPEED_TIERS)))
+    # else
+    s = "-preset {0}".format(presets[conf['speed']])
+    if conf['tune']:
+        s += " -tune {0}".format(conf['tune'])
+    return s
+
+def get_config(profile=None, **options):
+    """
+    The settings of a conversion: the config dictionary, the profile of
+    the machine, the given device profile and the options (in increasing
+    order of priority). See profiles.py.
+
+    Option values are converted to strings. Unknown options raise a
+    TypeError, an unknown profile raises a KeyError, an unknown speed
+    tier or job order raises a ValueError.
+    """
+    unknown = set(options) - set(config)
+    if unknown:
+        raise TypeError("unknown option(s): {0}".format(', '.join(sorted(unknown))))
+    # else
+    conf = dict(config)
+    layers = [profiles.machine_profile()]
+    if profile:
+        layers.append(profiles.device_profile(profile))
+    for layer in layers:
+        conf.update((k, v) for k, v in layer.items() if k in config)
+    conf.update((k, str(v)) for k, v in options.items())
+    for key in ('jobs', 'segments'):
+        conf[key] = str(max(1, int(conf[key])))
+    jobs = int(conf['jobs'])
+    threads_given = 'threads' in options or any('threads' in layer for layer in layers)
+    if jobs > 1 and not threads_given:
+        # split the core budget among the parallel encodes
+        conf['threads'] = str(max(1, utils.cpu_count() // jobs))
+    if conf['order'] not in scheduler.ORDERS:
+        raise ValueError("unknown job order: {0} (available: {1})".format(conf['order'], ', '.join(scheduler.ORDERS)))
+    # else
+    conf['x264_options'] = x264_options(conf)
+    return conf
+
+
+def profile_configs(names, **options):
+    """
+    The settings of each device profile for a multi-profile conversion:
+    a list of (profile name, get_config(name, **options)) pairs.
+    Raises the errors of get_config().
+    """
+    options.pop('profile', None)
+    return [(name, get_config(name, **options)) for name in names]
+
 
 def check_switches(args):
     """
-    Process arguments and if there is a switch among them, modify
-    the config part accordingly.
+    Process arguments and collect the switches among them.
 
-    Return value: argument list without switches.
+    Return value: (argument list without switches, options for get_config()).
+    The 'profiles' option is for profile_configs(), the 'trace' option
+    is for tracing.enable().
     """
-    global config
-    #
     copy = []
+    options = {}
     for e in args:
-        m = re.search(r'^-threads:(\d+)$', e)
+        m = re.search(r'^-(threads|jobs|segments|copy|table):(\d+)$', e)
         if m:
-            config['threads'] = m.group(1)
-        else:
-            copy.append(e)
+            options[m.group(1)] = m.group(2)
+            continue
+        m = re.search(r'^-(profile|profiles|speed|tune|report|trace|order):(\S+)$', e)
+        if m:
+            options[m.group(1)] = m.group(2)
+            continue
+        # else
+        copy.append(e)
     #
-    return copy
+    return copy, options
 
-sys.argv = check_switches(sys.argv)
+command_template = """{ffmpeg} -i \"%(input)s\" {video} -y {audio} -f mp4 \"%(output)s\""""
 
-command = """{ffmpeg} -i \"%(input)s\" -codec:v libx264 -quality good -cpu-used 0
--b:v {bitrate} -profile:v baseline -level 30 -y -maxrate 2000k
--bufsize 2000k -vf scale={width}:{height} -threads {threads} -codec:a %(audio_codec)s
--b:a 128k \"%(output)s\"""".replace('\n', ' ').format(**config)
+x264_encode = """-codec:v libx264 {x264_options} -b:v {bitrate} -profile:v baseline
+-level 30 -maxrate 2000k -bufsize 2000k -threads {threads}""".replace('\n', ' ')
+
+video_encode = "-vf scale={width}:{height} " + x264_encode
+
+AUDIO_BITRATE = '128k'
+audio_encode = "-codec:a {0} -b:a " + AUDIO_BITRATE
+
+video_copy, audio_copy = "-codec:v copy", "-codec:a copy"
+
+# what can be copied as it is (see fits_video() and fits_audio())
+H264_FORMATS = ('avc1', 'h264', 'x264')
+H264_BASELINE = 66
+H264_MAX_LEVEL = 30
+AAC_FORMATS = ('mp4a', '255')   # mplayer/mp4 and the AVI tag of AAC
+COPY_DEMUXERS = ('mov', 'mkv')  # parsed natively (see container.py)
+
+# one decode, several outputs (see resize_profiles())
+multi_template = """{ffmpeg} -i \"{input}\" -filter_complex \"{graph}\" -y {outputs}"""
+
+multi_output = """-map \"[v{index}]\" -map 0:a? {video} {audio} -f mp4 \"{output}\""""
+
+# cut the video stream at keyframes (no re-encoding)
+segment_split_template = """{ffmpeg} -i \"%(input)s\" -map 0:v:0 -an -codec copy -f segment
+-segment_time %(segment_time).3f -reset_timestamps 1 \"%(pattern)s\"""".replace('\n', ' ')
+
+# join the encoded parts and add the audio of the original
+segment_concat_template = """{ffmpeg} -f concat -safe 0 -i \"%(list)s\" -i \"%(input)s\"
+-map 0:v -map 1:a? -codec:v copy %(audio)s -y
+-f mp4 \"%(output)s\"""".replace('\n', ' ')
+
+# the banner of parallel jobs shouldn't get mixed up
+print_lock = Lock()
 
 audio_codec_problem = "Warning! There was a problem with the audio codec and the conversion failed. " + \
     "Retrying another method..."
 
+copy_problem = "Warning! Copying the streams failed. Retrying with encoding..."
+
 #############################################################################
 ##  end of config  ##########################################################
 #############################################################################
 
+def colored(text, color):
+    import termcolor    # loaded on first use, not at startup
+    return termcolor.colored(text, color)
+
+
 class Result(object):
     """
     A record to hold information about a converted video file.
@@ -127,100 +305,730 @@ class Result(object):
         self.file_name = None   # (str)
         self.file_size = 0      # (int)
         self.elapsed_time = 0.0 # (float)
+        self.video_length = None    # (float) in seconds, taken from the probe of the input
+        self.probe_time = None  # (float) seconds it took to probe the input
+        self.input_name = None  # (str)
+        self.profile = None     # (str) name of the device profile in multi-profile mode
+        self.encode_time = None # (float) seconds of the successful ffmpeg run
+        self.retry_time = 0.0   # (float) seconds of the ffmpeg runs that failed before
+        self.attempts = 0       # (int) number of ffmpeg runs
+        self.video_codec = None # (str) 'copy' if the stream was copied
+        self.audio_codec = None # (str) 'copy' if the stream was copied
+        self.skipped = False    # True: converted by an earlier run (see manifest.py)
+        self.cached = False     # True: served from the output cache (see outputcache.py)
+        self.rejected = False   # True: not started, the output wouldn't fit on the disk (see diskspace.py)
+
+
+def audio_codecs(conf):
+    """
+    Audio codecs to try, in order of preference.
+
+    Codecs that the ffmpeg binary doesn't have are left out, thus the
+    failsafe codec is only tried if the first one fails at runtime.
+    """
+    import capabilities
+    candidates = [conf['audio_codec'], conf['audio_codec_failsafe']]
+    caps = capabilities.get_capabilities(conf['ffmpeg'])
+    if caps is None:
+        return candidates   # cannot tell, try them one after the other
+    # else
+    usable = [c for c in candidates if caps.has_encoder(c.split()[0])]
+    if not usable:
+        print colored("Warning: {0} has none of the audio codecs {1}!".format(
+            conf['ffmpeg'], ', '.join(candidates)), "red")
+        return candidates
+    # else
+    return usable
+
+
+def missing_filters(conf, names):
+    """
+    The filters of names that the ffmpeg binary doesn't have. Empty if
+    it cannot tell (e.g. the list of filters couldn't be parsed).
+    """
+    import capabilities
+    caps = capabilities.get_capabilities(conf['ffmpeg'])
+    if caps is None or not caps.filters:
+        return []
+    # else
+    return [name for name in names if not caps.has_filter(name)]
+
+
+def ffmpeg_command(conf, fname, output, audio_codec=None, copy_video=False, copy_audio=False):
+    """
+    The ffmpeg command of a conversion. A copied stream is not encoded.
+    """
+    video = video_copy if copy_video else video_encode.format(**conf)
+    audio = audio_copy if copy_audio else audio_encode.format(audio_codec)
+    return command_template.format(ffmpeg=conf['ffmpeg'], video=video, audio=audio) % {
+        'input': fname, 'output': output}
+
+
+def settings_hash(conf):
+    """
+    Hash of the settings that determine the output. The number of
+    threads, jobs and segments doesn't matter.
+    """
+    video = video_encode.format(**dict(conf, threads=''))
+    settings = [conf['ffmpeg'], video, conf['audio_codec'], conf['audio_codec_failsafe'], conf['copy']]
+    return utils.string_to_md5('\n'.join(settings))
+
+
+def get_output_cache(conf):
+    """
+    The output cache or None if it's turned off.
+    """
+    import outputcache
+    max_bytes = int(conf['output_cache']) * 1024 * 1024
+    if max_bytes <= 0:
+        return None
+    # else
+    return outputcache.OutputCache(os.path.join(utils.get_cache_dir(), 'outputs'), max_bytes)
+
+
+def multi_command(fname, outputs, audio_codec):
+    """
+    The ffmpeg command that encodes several outputs from one decode.
+    outputs is a list of (conf, output file) pairs.
+    """
+    count = len(outputs)
+    graph = "[0:v]split={0}{1}".format(count, ''.join("[s{0}]".format(i) for i in range(count)))
+    for i, (conf, _) in enumerate(outputs):
+        graph += ";[s{0}]scale={1}:{2}[v{0}]".format(i, conf['width'], conf['height'])
+    parts = [multi_output.format(index=i, video=x264_encode.format(**conf),
+                                 audio=audio_encode.format(audio_codec), output=output)
+             for i, (conf, output) in enumerate(outputs)]
+    return multi_template.format(ffmpeg=outputs[0][0]['ffmpeg'], input=fname, graph=graph, outputs=' '.join(parts))
+
+
+def fits_video(info, conf):
+    """
+    Is the video stream H.264 baseline (level <= 3.0) and not bigger than the target size?
+    """
+    if info.get('ID_VIDEO_FORMAT', '').lower() not in H264_FORMATS:
+        return False
+    try:
+        profile = int(info['ID_VIDEO_PROFILE'])
+        constraints = int(info['ID_VIDEO_CONSTRAINTS'])
+        level = int(info['ID_VIDEO_LEVEL'])
+        width, height = int(info['ID_VIDEO_WIDTH']), int(info['ID_VIDEO_HEIGHT'])
+    except (KeyError, ValueError):
+        return False
+    # constraint_set0_flag: the stream obeys the constraints of baseline
+    baseline = profile == H264_BASELINE or constraints & 0x80
+    return bool(baseline) and level <= H264_MAX_LEVEL and \
+        0 < width <= int(conf['width']) and 0 < height <= int(conf['height'])
+
+
+def fits_audio(info):
+    return info.get('ID_AUDIO_FORMAT', '').lower() in AAC_FORMATS
+
+
+def plan_streams(fname, conf):
+    """
+    Which streams of the input can be copied as they are?
+
+    Return a (copy video, copy audio) pair. Only streams of natively
+    parsed MP4/MOV and MKV files are copied.
+    """
+    if conf['copy'] == '0':
+        return False, False
+    # else
+    info = utils.get_video_info(fname)
+    if info.get('ID_VIDEO_FORMAT', '').lower() in H264_FORMATS and 'ID_VIDEO_PROFILE' not in info:
+        import container
+        info = container.get_info(fname) or info    # probed before the profile was read
+    if info.get('ID_DEMUXER') not in COPY_DEMUXERS:
+        return False, False
+    # else
+    return fits_video(info, conf), fits_audio(info)
+
+
+def conversion_plans(fname, conf):
+    """
+    The ways to convert a file, to be tried in this order until one works.
+
+    Yield (copy video, copy audio, audio codec) triples. The streams that
+    fit the target are copied first; if that fails, everything is encoded.
+    The audio codecs are tried one after the other (see audio_codecs()).
+    Without the scale filter the video is not encoded.
+    """
+    copy_video, copy_audio = plan_streams(fname, conf)
+    if copy_video:
+        if copy_audio:
+            yield True, True, None
+        else:
+            for audio_codec in audio_codecs(conf):
+                yield True, False, audio_codec
+    if missing_filters(conf, ['scale']):
+        print colored("Warning: {0} has no scale filter, the video cannot be encoded!".format(conf['ffmpeg']), "red")
+        return
+    # else
+    if copy_audio and not copy_video:
+        yield False, True, None
+    for audio_codec in audio_codecs(conf):
+        yield False, False, audio_codec
+
+
+def use_segments(length, conf):
+    """
+    Should the video be encoded in parts?
+    """
+    return int(conf['segments']) > 1 and length >= float(conf['segment_min_length'])
+
+
+def encode_segmented(fname, output, audio_codec, copy_audio, length, conf):
+    """
+    Encode a long video in parts at the same time.
+
+    The video stream is cut at keyframes into segments, which are
+    encoded by conf['segments'] ffmpeg processes in parallel. The
+    encoded segments are joined with the concat demuxer (no re-encoding)
+    and the audio is encoded (or copied) in one piece during the join.
+
+    Return the exit code of the first failing ffmpeg call (0 if all went well).
+    """
+    import glob
+    import shutil
+    import tempfile
+    parts = int(conf['segments'])
+    # the job's share of the cores is divided among the parts
+    budget = max(1, utils.cpu_count() // int(conf['jobs']))
+    threads = max(1, budget // parts)
+    tmp_dir = tempfile.mkdtemp(prefix='.m2a-segments-', dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        pattern = os.path.join(tmp_dir, 'part%04d.mkv')
+        # more segments than processes, so that uneven cuts are balanced out
+        cmd = segment_split_template.format(**conf) % {'input': fname, 'pattern': pattern, 'segment_time': length / (2 * parts)}
+        with tracing.span('split', segment_time=length / (2 * parts)):
+            exit_code = utils.call_and_get_exit_code(cmd)
+        if exit_code != 0:
+            return exit_code
+        # else
+        pieces = [os.path.splitext(p)[0] + '.mp4' for p in sorted(glob.glob(os.path.join(tmp_dir, 'part*.mkv')))]
+        part_conf = dict(conf, threads=threads)
+        cmds = [ffmpeg_command(part_conf, os.path.splitext(p)[0] + '.mkv', p, audio_codec) for p in pieces]
+
+        def encode_part(cmd):
+            with tracing.span('segment', threads=threads):
+                return utils.call_and_get_exit_code(cmd)
+
+        for exit_code in utils.parallel_map(encode_part, cmds, parts):
+            if exit_code != 0:
+                return exit_code
+        # else
+        list_file = os.path.join(tmp_dir, 'parts.txt')
+        with open(list_file, 'w') as f:
+            for p in pieces:
+                f.write("file '{0}'\n".format(p.replace("'", "'\\''")))
+        audio = audio_copy if copy_audio else audio_encode.format(audio_codec)
+        cmd = segment_concat_template.format(**conf) % {'list': list_file, 'input': fname, 'output': output, 'audio': audio}
+        with tracing.span('concat', segments=len(pieces)):
+            return utils.call_and_get_exit_code(cmd)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def progress_printer(size_tuple, conf):
+    """
+    Progress callback of an encode. With parallel jobs every line
+    tells which file it belongs to.
+    """
+    if int(conf['jobs']) > 1:
+        return progress.ProgressPrinter(prefix="[{0} of {1}] ".format(*size_tuple), single_line=False)
+    # else
+    return progress.ProgressPrinter()
 
 
 def frame(fname, size_tuple):
+    """
+    Print a banner about the current file. Return the length of the video.
+    """
     index, full_size = size_tuple
-    t = utils.sec_to_hh_mm_ss(utils.get_video_length(fname))
+    length = utils.get_video_length(fname)
+    t = utils.sec_to_hh_mm_ss(length)
     s = "({index} of {full_size}) {fname} ({time})".format(
         index=index, full_size=full_size, fname=fname, time=t
     )
 
     size = len(s)
     horizontal = '+' + '-' * (size+2) + '+'
-    print termcolor.colored(horizontal, "green")
-    print termcolor.colored('| ' + s + ' |', "green")
-    print termcolor.colored(horizontal, "green")
+    with print_lock:
+        print colored(horizontal, "green")
+        print colored('| ' + s + ' |', "green")
+        print colored(horizontal, "green")
+    return length
 
 
-def resize(fname, size_tuple):
+def skipped_result(fname, settings):
+    """
+    A Result if fname was already converted with these settings
+    (see manifest.py), otherwise None.
+    """
+    with tracing.span('manifest.lookup'):
+        done = manifest.lookup(fname, settings)
+    if not done:
+        return None
+    # else
+    print colored("{0} is already converted ({1}), skipped.".format(fname, done), "green")
+    result = Result()
+    result.skipped = True
+    result.file_name = done
+    result.file_size = os.path.getsize(done)
+    result.video_length = utils.get_video_length(fname)
+    return result
+
+
+def cached_result(fname, output, settings, cache, key):
+    """
+    A Result if the output is served from the output cache, otherwise None.
+    """
+    part = manifest.part_file(output)
+    if not cache:
+        return None
+    # else
+    with tracing.span('cache.fetch') as span:
+        hit = cache.fetch(key, part)
+        span.set(hit=hit)
+    if not hit:
+        return None
+    # else
+    os.rename(part, output)
+    manifest.record(fname, settings, output)
+    print colored("{0} is served from the output cache ({1}).".format(fname, output), "green")
+    result = Result()
+    result.cached = True
+    result.file_name = output
+    result.file_size = os.path.getsize(output)
+    result.video_length = utils.get_video_length(fname)
+    return result
+
+
+def free_output(fname, output):
+    """
+    Can the output be written? An existing file is overwritten only
+    if it's an earlier output of fname (see manifest.py).
+    """
+    return not os.path.isfile(output) or manifest.recorded_output(fname, output)
+
+
+def output_estimate(fname, conf):
+    """
+    Estimated size of the output of fname, or rather the disk space the
+    conversion needs (see diskspace.py). A copied video stream is at most
+    as big as the input; an encode in segments needs room for the parts.
+    """
+    length = utils.get_video_length(fname)
+    copy_video, copy_audio = plan_streams(fname, conf)
+    if copy_video:
+        audio = 0 if copy_audio else diskspace.estimate(length, [AUDIO_BITRATE])
+        return os.path.getsize(fname) + audio + diskspace.OVERHEAD
+    # else
+    nbytes = diskspace.estimate(length, [conf['bitrate'], AUDIO_BITRATE])
+    if use_segments(length, conf):
+        nbytes = 2 * nbytes + os.path.getsize(fname)    # cut parts, encoded parts, the joined output
+    return nbytes
+
+
+def admit(fname, output, parts, nbytes, conf):
+    """
+    Disk space admission of a conversion (see diskspace.py). It may wait
+    while other conversions are running. Return a Reservation or None if
+    the output wouldn't fit.
+    """
+    directory = os.path.dirname(os.path.abspath(output))
+    min_free = int(conf['min_free']) * 1024 * 1024
+
+    def deferred():
+        print colored("Waiting for disk space for {0} (about {1})...".format(fname, utils.sizeof_fmt(nbytes)), "red")
+
+    with tracing.span('admission', bytes=nbytes) as span:
+        reservation = diskspace.admit(directory, parts, nbytes, min_free, deferred)
+        span.set(admitted=reservation is not None)
+    if reservation is None:
+        free = diskspace.free_bytes(directory) or 0
+        print colored("Warning: not enough disk space for {0} (about {1} needed, {2} free, {3} MB kept free)!".format(
+            fname, utils.sizeof_fmt(nbytes), utils.sizeof_fmt(free), conf['min_free']), "red")
+    return reservation
+
+
+def resize(fname, size_tuple, conf=None):
     """
     Resize the current video file with ffmpeg.
+
+    conf is the result of get_config() (default: get_config()).
     """
+    conf = conf or get_config()
     if not os.path.isfile(fname):
-        print termcolor.colored("Warning: the file {0} doesn't exist!".format(fname), "red")
+        print colored("Warning: the file {0} doesn't exist!".format(fname), "red")
         return Result(False)
     # else
 
+    settings = settings_hash(conf)
+    result = skipped_result(fname, settings)
+    if result:
+        return result
+    # else
+
     fileBaseName = os.path.splitext(fname)[0]
     output = fileBaseName+'.mp4'
-    if os.path.isfile(output):
+    if not free_output(fname, output):
         output = "{0}-resized.mp4".format(fileBaseName)
-    if os.path.isfile(output):
-        print termcolor.colored('Warning: the file {0} exists!'.format(output), "red")
+    if not free_output(fname, output):
+        print colored('Warning: the file {0} exists!'.format(output), "red")
         return Result(False)
 
     # else
+    cache = get_output_cache(conf)
+    key = cache.key(fname, settings) if cache else None
+    result = cached_result(fname, output, settings, cache, key)
+    if result:
+        return result
+    # else
+
     result = Result()
     timer = utils.Timer()
-
-    cmd = command % {'input': fname, 'output': output, 'audio_codec': config['audio_codec']}
     result.file_name = output
-    print termcolor.colored(cmd, "green")
-    frame(fname, size_tuple)
-    with timer:
-        exit_code = utils.call_and_get_exit_code(cmd)
-    if exit_code == 0:
-        print termcolor.colored("Success! Conversion time: {0:.1f} sec.".format(timer.elapsed_time()), "green")
-        print '#'
-        result.file_size = os.path.getsize(result.file_name)
+    part = manifest.part_file(output)
+    probe = utils.Timer()
+    with probe:
+        utils.get_video_info(fname)     # the later probes are served from the probe cache
+    result.probe_time = probe.elapsed_time()
+
+    reservation = admit(fname, output, [part], output_estimate(fname, conf), conf)
+    if reservation is None:
+        result.status, result.file_name, result.rejected = False, None, True
         return result
-    else:
-        print termcolor.colored(audio_codec_problem, "red")
-        os.unlink(output)
-        cmd = command % {'input': fname, 'output': output, 'audio_codec': config['audio_codec_failsafe']}
-        result.file_name = output
-        print termcolor.colored(cmd, "green")
-        frame(fname, size_tuple)
-        with timer:
-            exit_code = utils.call_and_get_exit_code(cmd)
-        if exit_code == 0:
-            print termcolor.colored("Success! Conversion time: {0:.1f} sec.".format(timer.elapsed_time()), "green")
-            print '#'
-            result.file_size = os.path.getsize(result.file_name)
-            return result
+    # else
+    try:
+        previous = None
+        for copy_video, copy_audio, audio_codec in conversion_plans(fname, conf):
+            if previous:
+                copied = previous[0] or previous[1]
+                print colored(copy_problem if copied and not (copy_video or copy_audio) else audio_codec_problem, "red")
+                if os.path.isfile(part):
+                    os.unlink(part)
+            previous = (copy_video, copy_audio)
+            cmd = ffmpeg_command(conf, fname, part, audio_codec, copy_video, copy_audio)
+            print colored(cmd, "green")
+            result.video_length = frame(fname, size_tuple)
+            with timer, tracing.span('ffmpeg', attempt=result.attempts + 1, copy_video=copy_video,
+                                     copy_audio=copy_audio, audio_codec=audio_codec) as span:
+                if not copy_video and use_segments(result.video_length, conf):
+                    exit_code = encode_segmented(fname, part, audio_codec, copy_audio, result.video_length, conf)
+                else:
+                    exit_code = progress.call_with_progress(cmd, progress_printer(size_tuple, conf),
+                                                            result.video_length)
+                span.set(exit_code=exit_code)
+            result.attempts += 1
+            if exit_code != 0:
+                result.retry_time += timer.elapsed_time()
+            else:
+                result.encode_time = timer.elapsed_time()
+                result.video_codec = 'copy' if copy_video else 'libx264'
+                result.audio_codec = 'copy' if copy_audio else audio_codec.split()[0]
+                os.rename(part, output)
+                with tracing.span('manifest.record'):
+                    manifest.record(fname, settings, output)
+                if cache:
+                    with tracing.span('cache.store'):
+                        cache.store(key, output)
+                print colored("Success! Conversion time: {0:.1f} sec.".format(timer.elapsed_time()), "green")
+                print '#'
+                with tracing.span('stat output'):
+                    result.file_size = os.path.getsize(result.file_name)
+                return result
+        #
+        if os.path.isfile(part):
+            os.unlink(part)
+        result.status, result.file_name = False, None   # keep the timings for the report
+        return result
+    finally:
+        reservation.release()
+
+
+def resize_profiles(fname, size_tuple, profiles):
+    """
+    Convert a video for several device profiles in one ffmpeg process.
+
+    The input is decoded once; the frames are split in the filter graph,
+    then scaled and encoded for each profile. profiles is a list of
+    (name, conf) pairs (see profile_configs()), the output of a profile
+    is <movie>-<name>.mp4. Streams are not copied in this mode.
+
+    Return a list of Results, one per profile.
+    """
+    if not os.path.isfile(fname):
+        print colored("Warning: the file {0} doesn't exist!".format(fname), "red")
+        return [Result(False) for _ in profiles]
+    # else
+    fileBaseName = os.path.splitext(fname)[0]
+    results = []
+    todo = []       # (index, conf, settings, cache, key, output) of the outputs to encode
+    for name, conf in profiles:
+        conf = dict(conf, copy='0')
+        settings = settings_hash(conf)
+        output = "{0}-{1}.mp4".format(fileBaseName, name)
+        result = skipped_result(fname, settings)
+        if result is None and not free_output(fname, output):
+            print colored('Warning: the file {0} exists!'.format(output), "red")
+            result = Result(False)
+        if result is None:
+            cache = get_output_cache(conf)
+            key = cache.key(fname, settings) if cache else None
+            result = cached_result(fname, output, settings, cache, key)
+            if result is None:
+                todo.append((len(results), conf, settings, cache, key, output))
+        results.append(result)
+    if not todo:
+        return results
+    # else
+    missing = missing_filters(todo[0][1], ['split', 'scale'])
+    if missing:
+        print colored("Warning: {0} has no {1} filter, {2} cannot be converted!".format(
+            todo[0][1]['ffmpeg'], ' and '.join(missing), fname), "red")
+        for job in todo:
+            results[job[0]] = Result(False)
+        return results
+    # else
+
+    timer = utils.Timer()
+    probe = utils.Timer()
+    with probe:
+        utils.get_video_info(fname)     # the later probes are served from the probe cache
+    retry_time = 0.0
+    parts = [(item[1], manifest.part_file(item[5])) for item in todo]   # (conf, part file) pairs
+    length = utils.get_video_length(fname)
+    nbytes = sum(diskspace.estimate(length, [job[1]['bitrate'], AUDIO_BITRATE]) for job in todo)
+    reservation = admit(fname, todo[0][5], [part for _, part in parts], nbytes, todo[0][1])
+    if reservation is None:
+        for job in todo:
+            results[job[0]] = Result(False)
+            results[job[0]].rejected = True
+        return results
+    # else
+    try:
+        for attempt, audio_codec in enumerate(audio_codecs(todo[0][1])):
+            if attempt > 0:
+                print colored(audio_codec_problem, "red")
+            for _, part in parts:
+                if os.path.isfile(part):
+                    os.unlink(part)
+            cmd = multi_command(fname, parts, audio_codec)
+            print colored(cmd, "green")
+            length = frame(fname, size_tuple)
+            with timer, tracing.span('ffmpeg', attempt=attempt + 1, audio_codec=audio_codec, outputs=len(parts)) as span:
+                exit_code = progress.call_with_progress(cmd, progress_printer(size_tuple, todo[0][1]), length)
+                span.set(exit_code=exit_code)
+            if exit_code != 0:
+                retry_time += timer.elapsed_time()
+            else:
+                for (index, _, settings, cache, key, output), (_, part) in zip(todo, parts):
+                    result = results[index] = Result()
+                    result.video_length = length
+                    result.elapsed_time = timer.elapsed_time()
+                    result.probe_time = probe.elapsed_time()
+                    result.encode_time = timer.elapsed_time()
+                    result.retry_time = retry_time
+                    result.attempts = attempt + 1
+                    result.video_codec = 'libx264'
+                    result.audio_codec = audio_codec.split()[0]
+                    try:
+                        os.rename(part, output)
+                    except OSError as e:
+                        print colored("Warning: {0} cannot be written ({1})!".format(output, e.strerror), "red")
+                        if os.path.isfile(part):
+                            os.unlink(part)
+                        result.status = False   # only this profile failed; keep the timings for the report
+                        continue
+                    # else
+                    manifest.record(fname, settings, output)
+                    if cache:
+                        cache.store(key, output)
+                    result.file_name = output
+                    result.file_size = os.path.getsize(output)
+                print colored("Success! Conversion time: {0:.1f} sec.".format(timer.elapsed_time()), "green")
+                print '#'
+                return results
+        #
+        for job in todo:
+            result = results[job[0]] = Result(False)     # keep the timings for the report
+            result.video_length = length
+            result.elapsed_time = probe.elapsed_time() + retry_time
+            result.probe_time = probe.elapsed_time()
+            result.retry_time = retry_time
+            result.attempts = len(audio_codecs(job[1]))
+        for _, part in parts:
+            if os.path.isfile(part):
+                os.unlink(part)
+        return results
+    finally:
+        reservation.release()
+
+
+def video_length(result):
+    """
+    Length of the converted video. The (cached) probe of the input
+    is used if possible, so the output doesn't have to be probed.
+    """
+    if result.video_length is not None:
+        return result.video_length
+    # else
+    return utils.get_video_length(result.file_name)
+
+
+def process(job, conf, profiles=None):
+    """
+    Convert one file of the batch and measure the conversion time.
+
+    job is an (index, file name, number of files) tuple. With profiles
+    (see resize_profiles()) a list of Results is returned.
+    """
+    index, fname, full_size = job
+    if profiles:
+        with tracing.span('job', file=fname, index=index):
+            results = resize_profiles(fname, (index, full_size), profiles)
+        for (name, _), result in zip(profiles, results):
+            result.input_name, result.profile = fname, name
+        return results
+    # else
+    timer = utils.Timer()
+    with timer, tracing.span('job', file=fname, index=index) as span:
+        result = resize(fname, (index, full_size), conf)
+        span.set(status=result.status)
+    #
+    result.elapsed_time = timer.elapsed_time()
+    result.input_name = fname
+    return result
+
+
+def job_cost(fname, conf):
+    """
+    Estimated cost of converting a file (see scheduler.cost()).
+    A file that cannot be probed costs 0.
+    """
+    try:
+        info = utils.get_video_info(fname)
+        copy_video = plan_streams(fname, conf)[0]
+    except (IOError, OSError, ValueError):
+        return 0.0
+    return scheduler.cost(info, copy_video)
+
+
+def schedule(jobs, conf):
+    """
+    The jobs in the order of conf['order'] (see scheduler.py). The
+    inputs are probed for their costs in parallel; the probes are
+    cached, so the conversions don't probe them again.
+    """
+    mode = scheduler.resolve(conf['order'], int(conf['jobs']))
+    if mode == scheduler.INPUT or len(jobs) < 2:
+        return jobs
+    # else
+    with tracing.span('schedule', order=mode, files=len(jobs)):
+        costs = utils.parallel_map(lambda job: job_cost(job[1], conf), jobs, int(conf['jobs']))
+    return scheduler.order(jobs, costs, mode)
+
+
+def run_jobs(args, conf, profiles=None):
+    """
+    Convert the files, conf['jobs'] of them at the same time.
+
+    The results are returned in the order of the input files
+    (with profiles, the results of a file in the order of the profiles).
+    """
+    jobs = schedule([(index, arg, len(args)) for index, arg in enumerate(args, start=1)], conf)
+    results = utils.parallel_map(lambda job: (job[0], process(job, conf, profiles)), jobs, int(conf['jobs']))
+    results = [result for _, result in sorted(results, key=lambda pair: pair[0])]
+    if profiles:
+        results = [result for file_results in results for result in file_results]
+    return results
+
+
+def iter_jobs(args, conf, profiles=None):
+    """
+    Like run_jobs(), but yield (index of the file, Result) pairs as soon
+    as the jobs finish (in the order of completion). The results are not
+    kept, so the memory use doesn't grow with the size of the batch.
+    """
+    jobs = schedule([(index, arg, len(args)) for index, arg in enumerate(args, start=1)], conf)
+    for index, result in utils.parallel_imap(lambda job: (job[0], process(job, conf, profiles)), jobs,
+                                             int(conf['jobs'])):
+        if profiles:
+            for r in result:
+                yield index, r
         else:
-            return Result(False)
+            yield index, result
 
 
-def main(args):
+def convert(path, profile=None, **options):
     """
-    process each argument
+    Convert a single movie and return a Result.
+
+    The options override the values of the config dictionary for this
+    call only, e.g. convert('movie.avi', threads=4). profile is the name
+    of a device profile (see profiles.py).
     """
+    return process((1, path, 1), get_config(profile, **options))
+
+
+def draw_table(records):
+    """
+    The summary table of a batch, a view of the run report records (see report.py).
+    """
+    from texttable import Texttable
     table = Texttable()
     table.set_cols_align(["r", "r", "r", "r", "r"])
     rows = [["Number", "File Name", "File Size", "Video Duration (H:MM:SS)", "Conversion Time"]]
+    for rec in sorted(records, key=lambda rec: rec['index']):
+        status = rec['status']
+        rows.append([rec['index'],
+                     rec['output'],
+                     utils.sizeof_fmt(rec['output_size'] or 0),
+                     utils.sec_to_hh_mm_ss(rec['media_seconds']) if rec['media_seconds'] is not None else "--",
+                     "skipped" if status == 'skipped' else
+                     "{0:.1f} sec. (cached)".format(rec['elapsed_time']) if status == 'cached' else
+                     "{0:.1f} sec.".format(rec['elapsed_time']) if status == 'ok' else
+                     "no disk space" if status == 'rejected' else FAILED])
+    table.add_rows(rows)
+    return table.draw()
+
+
+def main(args, conf=None, profiles=None):
+    """
+    process each argument
+
+    profiles: convert each file for several device profiles (see profile_configs()).
+
+    Each finished job is written to the run report right away (see
+    report.py). The table at the end is built from the same records;
+    with conf['table'] == '0' it's left out and the records are not kept
+    in memory (e.g. for a batch of 100k files).
+    """
+    import report
+    conf = conf or get_config()
+    show_table = conf['table'] != '0'
+    records = []
     total_time = 0.0
     total_file_size = 0
 
-    for index, arg in enumerate(args, start=1):
-        timer = utils.Timer()
-        with timer:
-            result = resize(arg, (index, len(args)))
-        #
-        result.elapsed_time = timer.elapsed_time()
-        rows.append([index,
-                     result.file_name,
-                     utils.sizeof_fmt(result.file_size),
-                     utils.sec_to_hh_mm_ss(utils.get_video_length(result.file_name)) if result.file_name else "--",
-                     "{0:.1f} sec.".format(result.elapsed_time) if result.status else FAILED])
-        #
-        if rows[-1][-1] != FAILED:
-            total_time += result.elapsed_time
-        total_file_size += result.file_size
+    try:
+        out = report.Report(conf['report']).open()
+    except IOError as e:
+        print colored("Error: the report cannot be written ({0}).".format(e), "red")
+        sys.exit(1)
+    with out, tracing.span('batch', files=len(args)):
+        for index, result in iter_jobs(args, conf, profiles):
+            rec = report.record(index, result, video_length(result) if result.file_name else result.video_length)
+            out.write(rec)
+            if show_table:
+                records.append(rec)
+            if result.status:
+                total_time += result.elapsed_time
+            total_file_size += result.file_size
 
-    table.add_rows(rows)
-    print table.draw()
+    if show_table:
+        print draw_table(records)
     print 'Total file size:', utils.sizeof_fmt(total_file_size)
     print 'Total time: {0} (H:MM:SS)'.format(utils.sec_to_hh_mm_ss(total_time))
     print utils.get_unix_date()
@@ -228,8 +1036,38 @@ def main(args):
 #############################################################################
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    if '-h' in sys.argv[1:] or '--help' in sys.argv[1:]:
+        print __doc__
+        sys.exit(0)
+    # else
+    args, options = check_switches(sys.argv[1:])
+    if len(args) < 1:
         print "Usage: {0} <movie>".format(os.path.split(sys.argv[0])[1])
+        print "       {0} benchmark [clip]".format(os.path.split(sys.argv[0])[1])
+        print "       {0} calibrate [clip]".format(os.path.split(sys.argv[0])[1])
         sys.exit(1)
     else:
-        main(sys.argv[1:])
+        if 'trace' in options:
+            try:
+                tracing.enable(options.pop('trace'))
+            except OSError as e:
+                print colored("Error: the trace cannot be written ({0}).".format(e), "red")
+                sys.exit(1)
+        try:
+            names = options.pop('profiles', None)
+            conf = get_config(**options)
+            targets = profile_configs(names.split(','), **options) if names else None
+        except KeyError as e:
+            print "Unknown profile: {0} (available: {1})".format(e.args[0], ', '.join(profiles.device_names()))
+            sys.exit(1)
+        except ValueError as e:
+            print e
+            sys.exit(1)
+        if args[0] == 'benchmark':
+            import benchmark
+            benchmark.main(args[1:], conf)
+        elif args[0] == 'calibrate':
+            import calibrate
+            calibrate.main(args[1:], conf)
+        else:
+            main(args, conf, targets)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed cache of the converted movies.
+
+The same movie is often converted again from another directory or
+mount. A finished output is stored under a key made of a hash of the
+input's content and the hash of the settings (see
+movie2android.settings_hash()). If the key is found, the output is
+served from the cache by a hard link (or a copy on another file
+system) instead of an encode.
+
+Hashing a whole movie would take about as long as reading it, thus only
+samples are hashed: the head, the tail and evenly strided chunks between
+them (read through mmap), together with the size of the file.
+
+The cache lives in the cache directory (outputs/) and is size-bounded:
+the least recently used entries are evicted first. An output is copied
+into the cache (the user may edit or touch the file), only a hit is
+served by a hard link. Each entry has a stamp file (<key>.used): its
+modification time is the last use, its content the size and the
+modification time of the entry. An entry that was changed through a
+link of a hit doesn't match its stamp and is dropped.
+"""
+
+import os
+import shutil
+from threading import Lock, current_thread
+
+HEAD = TAIL = 1024 * 1024       # bytes hashed at the beginning and at the end
+CHUNK = 64 * 1024               # size of a strided sample
+CHUNKS = 32                     # number of strided samples
+
+_lock = Lock()
+
+
+def sample_hash(fname):
+    """
+    Hash of the size, the head, the tail and strided chunks of a file.
+    Small files are hashed completely. Raises IOError/OSError.
+    """
+    import hashlib
+    import mmap
+    h = hashlib.md5()
+    size = os.path.getsize(fname)
+    h.update(str(size))
+    if size == 0:
+        return h.hexdigest()
+    # else
+    with open(fname, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if size <= HEAD + TAIL + CHUNKS * CHUNK:
+                h.update(m[:])
+            else:
+                h.update(m[:HEAD])
+                stride = (size - HEAD - TAIL) // CHUNKS
+                for i in xrange(CHUNKS):
+                    pos = HEAD + i * stride
+                    h.update(m[pos:pos+CHUNK])
+                h.update(m[size-TAIL:])
+        finally:
+            m.close()
+    return h.hexdigest()
+
+
+def link_or_copy(src, dest):
+    """
+    Hard link src to dest; copy it if they are on different file systems.
+    """
+    if os.path.exists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class OutputCache(object):
+    """
+    Size-bounded store of converted movies, keyed by input and settings.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, fname, settings):
+        return "{0}-{1}".format(sample_hash(fname), settings)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.mp4')
+
+    def stamp_file(self, path):
+        return os.path.splitext(path)[0] + '.used'
+
+    def remove(self, path):
+        for fname in (path, self.stamp_file(path)):
+            try:
+                os.unlink(fname)
+            except OSError:
+                pass
+
+    def fetch(self, key, dest):
+        """
+        Put the cached output of key to dest. Return True on a hit.
+        """
+        path = self.path(key)
+        stamp = self.stamp_file(path)
+        try:
+            st = os.stat(path)
+            with open(stamp) as f:
+                intact = f.read().split() == [str(st.st_size), repr(st.st_mtime)]
+        except (IOError, OSError):
+            return False
+        if not intact:
+            self.remove(path)   # modified through the link of an earlier hit
+            return False
+        # else
+        try:
+            link_or_copy(path, dest)
+            os.utime(stamp, None)   # the modification time of the stamp tells when it was used last
+            return True
+        except (IOError, OSError):
+            return False
+
+    def store(self, key, fname):
+        """
+        Add a converted movie to the cache, then evict the least
+        recently used entries if the cache is too big. Errors are
+        ignored (it's just a cache).
+        """
+        if os.path.getsize(fname) > self.max_bytes:
+            return
+        # else
+        path = self.path(key)
+        # unique per process and thread: workers store concurrently
+        tmp = "{0}.{1}.{2}.tmp".format(path, os.getpid(), current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copyfile(fname, tmp)
+            st = os.stat(tmp)
+            with open(self.stamp_file(path), 'w') as f:
+                f.write("{0} {1!r}\n".format(st.st_size, st.st_mtime))
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            if os.path.isfile(tmp):
+                os.unlink(tmp)
+            return
+        # else
+        self.evict()
+
+    def entries(self):
+        """
+        (time of the last use, size, path) of the cached files.
+        """
+        result = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.mp4'):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue    # evicted by another process
+                    try:
+                        used = os.path.getmtime(self.stamp_file(path))
+                    except OSError:
+                        used = st.st_mtime
+                    result.append((used, st.st_size, path))
+        return result
+
+    def evict(self):
+        with _lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self.remove(path)
+                total -= size
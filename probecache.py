@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+Persistent cache for the video info returned by utils.get_video_info().
+
+An entry is keyed by (absolute path, file size, modification time), thus
+a file is probed again only if it changed. The whole 'ID_*' dictionary
+is stored in an SQLite database and the most recently used entries are
+also kept in memory. Both layers are size-bounded, the least recently
+used entries are evicted first.
+
+The paths are stored as byte strings (in any encoding). An error of the
+database (e.g. locked or read-only) makes it a cache miss; a misuse of
+the sqlite3 API (ProgrammingError) is a bug and is raised.
+"""
+
+import os
+import json
+import time
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+
+MEMORY_SIZE = 512       # number of entries kept in memory
+DISK_SIZE = 50000       # number of entries kept in the database
+EVICT_EVERY = 100       # check the size of the database after this many insertions
+
+
+class ProbeCache(object):
+    """
+    Two-level (memory + SQLite) LRU cache of video infos.
+
+    If the database cannot be used (e.g. read-only file system), the
+    cache silently falls back to memory only.
+    """
+    def __init__(self, db_file, memory_size=MEMORY_SIZE, disk_size=DISK_SIZE):
+        self.db_file = db_file
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.lock = Lock()
+        self.conn = None
+        self.disk_ok = True
+        self.insertions = 0
+
+    @staticmethod
+    def key(fname):
+        """
+        Cache key of a file. Raises OSError if the file doesn't exist.
+        """
+        st = os.stat(fname)
+        return (os.path.abspath(fname), st.st_size, st.st_mtime)
+
+    def _connect(self):
+        if self.conn is None and self.disk_ok:
+            try:
+                conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+                conn.text_factory = str     # the paths are byte strings
+                conn.execute("""CREATE TABLE IF NOT EXISTS probe (
+                                    path TEXT PRIMARY KEY,
+                                    size INTEGER,
+                                    mtime REAL,
+                                    info TEXT,
+                                    used REAL)""")
+                conn.execute("CREATE INDEX IF NOT EXISTS probe_used ON probe (used)")
+                conn.commit()
+                self.conn = conn
+            except sqlite3.ProgrammingError:
+                raise
+            except sqlite3.Error:
+                self.disk_ok = False
+        return self.conn
+
+    def _remember(self, key, info):
+        self.memory.pop(key, None)
+        self.memory[key] = info
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Return a copy of the cached info or None if it's not in the cache.
+        """
+        with self.lock:
+            if key in self.memory:
+                info = self.memory.pop(key)
+                self.memory[key] = info
+                return dict(info)
+            # else
+            conn = self._connect()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute("SELECT info FROM probe WHERE path=? AND size=? AND mtime=?",
+                                   key).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE probe SET used=? WHERE path=?", (time.time(), key[0]))
+                conn.commit()
+            except sqlite3.ProgrammingError:
+                raise
+            except sqlite3.Error:
+                return None
+            info = json.loads(row[0])
+            self._remember(key, info)
+            return dict(info)
+
+    def put(self, key, info):
+        """
+        Store the info of a file (replacing the info of its earlier versions).
+        """
+        path, size, mtime = key
+        with self.lock:
+            self._remember(key, dict(info))
+            conn = self._connect()
+            if conn is None:
+                return
+            try:
+                data = json.dumps(info)
+            except (ValueError, UnicodeError):
+                return      # e.g. a value that is not UTF-8: kept in memory only
+            # else
+            try:
+                conn.execute("INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?)",
+                             (path, size, mtime, data, time.time()))
+                self.insertions += 1
+                if self.insertions % EVICT_EVERY == 0:
+                    self._evict(conn)
+                conn.commit()
+            except sqlite3.ProgrammingError:
+                raise
+            except sqlite3.Error:
+                pass
+
+    def _evict(self, conn):
+        count = conn.execute("SELECT COUNT(*) FROM probe").fetchone()[0]
+        if count > self.disk_size:
+            conn.execute("""DELETE FROM probe WHERE path IN
+                            (SELECT path FROM probe ORDER BY used LIMIT ?)""",
+                         (count - self.disk_size,))
+
+    def clear(self):
+        """
+        Remove every entry from both layers.
+        """
+        with self.lock:
+            self.memory.clear()
+            conn = self._connect()
+            if conn is not None:
+                try:
+                    conn.execute("DELETE FROM probe")
+                    conn.commit()
+                except sqlite3.ProgrammingError:
+                    raise
+                except sqlite3.Error:
+                    pass
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""
+Machine and device profiles.
+
+A profile is a set of config values. Machine profiles are selected by
+the short fingerprint of the host (see utils.get_short_fingerprint()),
+device profiles by name (e.g. -profile:tablet). Besides the built-in
+profiles below, they can be defined in an INI file,
+$XDG_CONFIG_HOME/movie2android/profiles.ini (~/.config/... by default):
+
+    [defaults]              ; applies everywhere
+    ffmpeg = /opt/ffmpeg/ffmpeg
+
+    [machine:a804db]        ; applies on the machine with this fingerprint
+    threads = 4
+
+    [device:tablet]         ; used with -profile:tablet
+    width = 1024
+    height = 600
+    bitrate = 1200k
+
+The result of the calibration (./movie2android.py calibrate, see
+calibrate.py) is saved per machine in the cache directory and used as
+the machine profile's threads and jobs. A [machine:...] section of the
+file still has the last word.
+
+Run this module to see the fingerprint of the current machine.
+
+The fingerprint is computed only once per machine: it's cached
+(with the host name) in the cache directory.
+"""
+
+import os
+import json
+import socket
+from threading import Lock
+import utils
+
+CONFIG_FILE = 'profiles.ini'
+HOST_CACHE = 'host.json'
+CALIBRATION_FILE = 'calibration.json'
+
+# built-in machine profiles: {short fingerprint: {key: value}}
+MACHINE_PROFILES = {
+    'a804db': {'threads': '4'},     # on my home desktop I want this to be the default
+}
+
+# built-in device profiles
+DEVICE_PROFILES = {
+    'phone': {'width': '480', 'height': '320', 'bitrate': '600k'},
+    'tablet': {'width': '1024', 'height': '600', 'bitrate': '1200k'},
+}
+
+_lock = Lock()
+_loaded = None          # (defaults, machines, devices) read from the file
+_machine = None         # the resolved profile of this machine
+
+
+def get_config_file():
+    base = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return os.path.join(base, 'movie2android', CONFIG_FILE)
+
+
+def load(path=None):
+    """
+    Read the profile file. Return (defaults, machine profiles, device profiles).
+    Missing file: empty profiles.
+    """
+    from ConfigParser import RawConfigParser     # only if there is a file to read
+    defaults, machines, devices = {}, {}, {}
+    path = path or get_config_file()
+    if not os.path.isfile(path):
+        return defaults, machines, devices
+    # else
+    parser = RawConfigParser()
+    parser.read(path)
+    for section in parser.sections():
+        values = dict(parser.items(section))
+        kind, _, name = section.partition(':')
+        if section == 'defaults':
+            defaults.update(values)
+        elif kind == 'machine' and name:
+            machines.setdefault(name.strip(), {}).update(values)
+        elif kind == 'device' and name:
+            devices.setdefault(name.strip(), {}).update(values)
+    return defaults, machines, devices
+
+
+def _profiles():
+    global _loaded
+    if _loaded is None:
+        _loaded = load()
+    return _loaded
+
+
+def get_fingerprint():
+    """
+    Short fingerprint of this machine, cached on disk per host name.
+    """
+    node = socket.gethostname()
+    cache_file = os.path.join(utils.get_cache_dir(), HOST_CACHE)
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached.get('node') == node:
+            return str(cached['fingerprint'])
+    except (IOError, ValueError, KeyError):
+        pass
+    #
+    fingerprint = utils.get_short_fingerprint()
+    try:
+        with open(cache_file, 'w') as f:
+            json.dump({'node': node, 'fingerprint': fingerprint}, f)
+    except IOError:
+        pass
+    return fingerprint
+
+
+def get_calibration_file():
+    return os.path.join(utils.get_cache_dir(), CALIBRATION_FILE)
+
+
+def load_calibrations():
+    """
+    The saved calibrations: {fingerprint: calibration}. Missing file: {}.
+    """
+    try:
+        with open(get_calibration_file()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def calibration():
+    """
+    The calibration of this machine ({'threads': .., 'jobs': .., ...}) or None.
+    """
+    calibrations = load_calibrations()
+    if not calibrations:
+        return None
+    # else
+    return calibrations.get(get_fingerprint())
+
+
+def save_calibration(threads, jobs, measurements):
+    """
+    Save the calibration of this machine. It's used from the next
+    process on (see machine_profile()). Return the path of the file.
+    """
+    calibrations = load_calibrations()
+    calibrations[get_fingerprint()] = {
+        'node': socket.gethostname(),
+        'threads': threads,
+        'jobs': jobs,
+        'cores': utils.cpu_count(),
+        'date': utils.get_unix_date(),
+        'measurements': measurements,
+    }
+    path = get_calibration_file()
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(calibrations, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+    return path
+
+
+def machine_profile():
+    """
+    Config values of this machine: the [defaults] section, the built-in
+    profile of the fingerprint, the calibration and the profile of the
+    fingerprint in the file. Resolved once per process.
+    """
+    global _machine
+    with _lock:
+        if _machine is None:
+            defaults, machines, _ = _profiles()
+            profile = dict(defaults)
+            calibrations = load_calibrations()
+            if MACHINE_PROFILES or machines or calibrations:
+                fingerprint = get_fingerprint()
+                profile.update(MACHINE_PROFILES.get(fingerprint, {}))
+                calibrated = calibrations.get(fingerprint)
+                if calibrated:
+                    profile.update(threads=str(calibrated['threads']), jobs=str(calibrated['jobs']))
+                profile.update(machines.get(fingerprint, {}))
+            _machine = profile
+    return _machine
+
+
+def device_names():
+    with _lock:
+        return sorted(set(DEVICE_PROFILES) | set(_profiles()[2]))
+
+
+def device_profile(name):
+    """
+    Config values of a device. Raises KeyError if there is no such profile.
+    """
+    with _lock:
+        devices = _profiles()[2]
+        if name not in DEVICE_PROFILES and name not in devices:
+            raise KeyError(name)
+        profile = dict(DEVICE_PROFILES.get(name, {}))
+        profile.update(devices.get(name, {}))
+    return profile
+
+#############################################################################
+
+if __name__ == "__main__":
+    print "Fingerprint of this machine:", get_fingerprint()
+    print "Profile file:", get_config_file()
+    print "Calibration:", get_calibration_file() if calibration() else None
+    print "Machine profile:", machine_profile()
+    for name in device_names():
+        print "Device profile {0}: {1}".format(name, device_profile(name))
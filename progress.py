@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+Follow the progress of an ffmpeg encode.
+
+ffmpeg is started with `-progress pipe:1 -nostats`. Then it writes
+blocks of key=value lines to its standard output, each block ending
+with a 'progress=continue' (or 'progress=end') line:
+
+    frame=1234
+    fps=81.20
+    out_time_us=51416000
+    speed=3.38x
+    progress=continue
+
+The output is parsed line by line as it arrives, nothing is buffered.
+"""
+
+import sys
+import time
+import shlex
+from subprocess import Popen, PIPE
+import utils
+
+
+class Progress(object):
+    """
+    A snapshot of a running encode.
+    """
+    def __init__(self):
+        self.frame = 0          # (int) frames encoded so far
+        self.fps = 0.0          # (float) encoding speed in frames per second
+        self.speed = 0.0        # (float) encoding speed relative to realtime (2.0 = 2x)
+        self.out_time = 0.0     # (float) seconds of output written so far
+        self.duration = None    # (float) length of the input in seconds (if known)
+        self.elapsed = 0.0      # (float) wall time since the start of the encode
+        self.done = False       # (bool) True in the last snapshot
+
+    def percent(self):
+        """
+        Percentage done or None if the length of the input is not known.
+        """
+        if not self.duration:
+            return None
+        return min(100.0, 100.0 * self.out_time / self.duration)
+
+    def eta(self):
+        """
+        Estimated remaining time in seconds or None if it cannot be estimated.
+        """
+        if self.done:
+            return 0.0
+        if not self.duration or self.out_time <= 0:
+            return None
+        left = max(0.0, self.duration - self.out_time)
+        if self.speed > 0:
+            return left / self.speed
+        # else
+        return left * self.elapsed / self.out_time
+
+    def __str__(self):
+        s = "frame={0} fps={1:.1f} speed={2:.2f}x time={3}".format(
+            self.frame, self.fps, self.speed, utils.sec_to_hh_mm_ss(self.out_time))
+        percent = self.percent()
+        if percent is not None:
+            s += " ({0:.1f}%)".format(percent)
+        eta = self.eta()
+        if eta is not None:
+            s += " ETA {0}".format(utils.sec_to_hh_mm_ss(eta))
+        return s
+
+
+def to_float(value):
+    try:
+        return float(value.rstrip('x'))
+    except ValueError:
+        return 0.0      # e.g. 'N/A'
+
+
+def parse_out_time(values):
+    """
+    Output time in seconds from a block of progress values.
+    """
+    # out_time_ms is in microseconds too (a long-standing ffmpeg quirk)
+    for key in ('out_time_us', 'out_time_ms'):
+        if key in values:
+            return max(0.0, to_float(values[key]) / 1e6)
+    if 'out_time' in values:
+        seconds = 0.0
+        for part in values['out_time'].lstrip('-').split(':'):
+            seconds = seconds * 60 + to_float(part)
+        return seconds
+    return 0.0
+
+
+def iter_progress(stream, duration=None):
+    """
+    Read ffmpeg's progress output from stream and yield a Progress
+    object after each block.
+    """
+    start = time.time()
+    values = {}
+    # readline() instead of iteration: the file iterator of Python 2 reads ahead
+    for line in iter(stream.readline, ''):
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        values[key] = value
+        if key == 'progress':
+            p = Progress()
+            p.frame = int(to_float(values.get('frame', '0')))
+            p.fps = to_float(values.get('fps', '0'))
+            p.speed = to_float(values.get('speed', '0'))
+            p.out_time = parse_out_time(values)
+            p.duration = duration
+            p.elapsed = time.time() - start
+            p.done = (value == 'end')
+            yield p
+            values = {}
+
+
+def call_with_progress(cmd, callback=None, duration=None):
+    """
+    Execute an ffmpeg command and call callback(progress) with
+    a Progress object whenever ffmpeg reports its progress.
+
+    duration is the length of the input (needed for the ETA).
+    Return the exit code of ffmpeg.
+    """
+    args = shlex.split(cmd)
+    args[1:1] = ['-progress', 'pipe:1', '-nostats']
+    process = Popen(args, stdout=PIPE)
+    for p in iter_progress(process.stdout, duration):
+        if callback:
+            callback(p)
+    return process.wait()
+
+
+class ProgressPrinter(object):
+    """
+    A callback for call_with_progress() that shows the progress in the terminal.
+
+    With a single job the status line is updated in place. If several
+    jobs are running at the same time, a line (starting with the given
+    prefix) is printed every `interval` seconds.
+    """
+    def __init__(self, prefix='', single_line=True, interval=10.0, stream=None):
+        self.prefix = prefix
+        self.single_line = single_line
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.last = 0.0
+        self.width = 0
+
+    def __call__(self, p):
+        if self.single_line:
+            line = self.prefix + str(p)
+            self.stream.write('\r' + line.ljust(self.width))
+            self.width = len(line)
+            if p.done:
+                self.stream.write('\n')
+            self.stream.flush()
+        else:
+            now = time.time()
+            if p.done or now - self.last >= self.interval:
+                self.last = now
+                self.stream.write(self.prefix + str(p) + '\n')
+                self.stream.flush()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Machine-readable run report.
+
+With -report:<file>, every finished conversion is written to the file
+as one record as soon as it's done, so the stats of a batch are not lost
+if the process dies in the middle. The format is CSV if the file name
+ends with .csv, otherwise JSON lines; -report:- writes JSON lines to the
+standard output.
+
+The file is appended to: a restarted batch continues its report. The
+CSV header is written only to a new (empty) file. The file names are
+written as text (see manifest.text()): UTF-8 in a CSV file.
+
+A record has these fields (times in seconds):
+
+    date, index, input, input_size, profile, status (ok, skipped, cached,
+    failed, rejected: no disk space), output, output_size, media_seconds,
+    probe_time, encode_time, retry_time (encodes that failed and were
+    retried), elapsed_time, realtime_factor (media_seconds / encode_time),
+    attempts, video_codec, audio_codec ('copy' if the stream was copied)
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import manifest
+
+FIELDS = ('date', 'index', 'input', 'input_size', 'profile', 'status', 'output', 'output_size',
+          'media_seconds', 'probe_time', 'encode_time', 'retry_time', 'elapsed_time',
+          'realtime_factor', 'attempts', 'video_codec', 'audio_codec')
+
+
+def status_of(result):
+    if not result.status:
+        return 'rejected' if result.rejected else 'failed'
+    # else
+    return 'skipped' if result.skipped else 'cached' if result.cached else 'ok'
+
+
+def name(fname):
+    return manifest.text(fname) if fname else fname
+
+
+def record(index, result, media_seconds=None):
+    """
+    The record of a finished job (a dict with the keys in FIELDS).
+
+    index is the number of the input in the batch, media_seconds the
+    length of the video (if known).
+    """
+    try:
+        input_size = os.path.getsize(result.input_name) if result.input_name else None
+    except OSError:
+        input_size = None
+    encode_time = result.encode_time
+    realtime = media_seconds / encode_time if media_seconds and encode_time else None
+    return {
+        'date': round(time.time(), 3),
+        'index': index,
+        'input': name(result.input_name),
+        'input_size': input_size,
+        'profile': result.profile,
+        'status': status_of(result),
+        'output': name(result.file_name),
+        'output_size': result.file_size if result.status else None,
+        'media_seconds': media_seconds,
+        'probe_time': result.probe_time,
+        'encode_time': encode_time,
+        'retry_time': result.retry_time,
+        'elapsed_time': result.elapsed_time,
+        'realtime_factor': round(realtime, 3) if realtime else None,
+        'attempts': result.attempts,
+        'video_codec': result.video_codec,
+        'audio_codec': result.audio_codec,
+    }
+
+
+class Report(object):
+    """
+    Writes the records to a file (see the module docstring). With an
+    empty path nothing is written. Use it as a context manager; open()
+    it first to find out if the file can be written (IOError).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.writer = None
+
+    def __enter__(self):
+        return self.open()
+
+    def open(self):
+        if not self.path or self.f is not None:
+            return self
+        # else
+        if self.path == '-':
+            self.f = sys.stdout
+        else:
+            self.f = open(self.path, 'ab')
+        if self.path.lower().endswith('.csv'):
+            self.writer = csv.DictWriter(self.f, FIELDS)
+            if self.f.tell() == 0:
+                self.writer.writeheader()
+        return self
+
+    def write(self, rec):
+        if self.f is None:
+            return
+        # else
+        if self.writer:
+            self.writer.writerow(dict((k, '' if v is None else v.encode('utf-8') if isinstance(v, unicode) else v)
+                                      for k, v in rec.items()))
+        else:
+            self.f.write(json.dumps(rec, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def __exit__(self, type, value, traceback): #@ReservedAssignment
+        if self.f is not None and self.f is not sys.stdout:
+            self.f.close()
+        self.f = None
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+Order of the jobs of a parallel batch.
+
+With -jobs:<n> the files are handed to n slots in list order: a free
+slot takes the next file. If a long movie comes last, it keeps the
+batch running long after the other slots went idle. Handing out the
+longest jobs first (LPT) packs the jobs evenly onto the slots: the
+batch takes at most 4/3 of the shortest possible time. The shortest
+jobs first (SPT) gives the first results soonest.
+
+    -order:auto         longest first with several jobs, otherwise input order (default)
+    -order:input        the order of the arguments
+    -order:longest      longest first (shortest total time)
+    -order:shortest     shortest first (fastest first results)
+
+The cost of a job is estimated from the probe of the input: length
+times width times height, i.e. the pixels to be decoded and encoded.
+A stream copy (see movie2android.plan_streams()) costs a fraction of
+an encode.
+"""
+
+AUTO, INPUT, LONGEST, SHORTEST = 'auto', 'input', 'longest', 'shortest'
+ORDERS = (AUTO, INPUT, LONGEST, SHORTEST)
+
+DEFAULT_PIXELS = 720 * 576      # if the probe has no resolution
+COPY_FACTOR = 0.02              # a remux costs about this much of an encode
+
+
+def resolve(order, slots):
+    """
+    The effective order with the given number of parallel slots.
+    """
+    if order == AUTO:
+        return LONGEST if slots > 1 else INPUT
+    # else
+    return order
+
+
+def cost(info, copy_video=False):
+    """
+    Estimated cost of converting a video (see the module docstring).
+    info is the result of utils.get_video_info().
+    """
+    try:
+        length = float(info.get('ID_LENGTH', 0))
+    except ValueError:
+        length = 0.0
+    try:
+        pixels = int(info['ID_VIDEO_WIDTH']) * int(info['ID_VIDEO_HEIGHT'])
+    except (KeyError, ValueError):
+        pixels = DEFAULT_PIXELS
+    result = length * pixels
+    return result * COPY_FACTOR if copy_video else result
+
+
+def order(items, costs, mode):
+    """
+    The items sorted by their costs (longest or shortest first).
+    Items of the same cost keep their order.
+    """
+    if mode not in (LONGEST, SHORTEST):
+        return list(items)
+    # else
+    ranked = sorted(range(len(items)), key=lambda i: costs[i], reverse=(mode == LONGEST))
+    return [items[i] for i in ranked]
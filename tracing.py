@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+Span tracing in the Chrome trace-event format.
+
+    with tracing.span('probe', file=fname):
+        ...
+
+A span is a named, timed block. Spans of a thread nest like the blocks
+of the code; every thread and every process has its own track. Open the
+trace in chrome://tracing or https://ui.perfetto.dev.
+
+Tracing is off by default; then span() returns a shared do-nothing
+object, so the cost of a span is a function call. It's turned on by
+the environment variable M2A_TRACE=<file> (inherited by the worker
+processes, e.g. the server and its remote workers on the same machine)
+or by enable(<file>) (the -trace:<file> switch of movie2android.py).
+
+The processes append their events to the same file as soon as a span
+ends, one event per line. The file is a JSON array without the closing
+bracket, which the trace viewers accept; thus the trace is usable even
+if a process is killed. Timestamps are wall-clock microseconds, so the
+tracks of the processes line up.
+"""
+
+import os
+import json
+import time
+import errno
+import threading
+
+ENV_VAR = 'M2A_TRACE'
+
+_lock = threading.Lock()
+_fd = None              # the trace file (None: tracing is off)
+_named = set()          # (pid, tid) pairs whose thread name was written
+
+
+class _NullSpan(object):
+    """
+    The span of a disabled tracer.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback): #@ReservedAssignment
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL = _NullSpan()
+
+
+class Span(object):
+    """
+    A timed block. Arguments added with set() are shown in the viewer.
+    """
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback): #@ReservedAssignment
+        end = time.time()
+        if type is not None:
+            self.args['error'] = type.__name__
+        thread = threading.current_thread()
+        _emit({'name': self.name, 'ph': 'X', 'ts': int(self.start * 1e6), 'dur': int((end - self.start) * 1e6),
+               'pid': os.getpid(), 'tid': thread.ident, 'args': self.args}, thread)
+        return False
+
+
+def enabled():
+    return _fd is not None
+
+
+def span(name, **args):
+    """
+    A context manager that records the block as a span (if tracing is on).
+    """
+    if _fd is None:
+        return _NULL
+    # else
+    return Span(name, args)
+
+
+def enable(path):
+    """
+    Append the spans of this process to path (created if necessary).
+    """
+    global _fd
+    with _lock:
+        if _fd is not None:
+            os.close(_fd)
+            _fd = None
+        try:
+            # the first process opens the JSON array
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0644)
+            os.write(fd, '[\n')
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        _fd = fd
+        _named.clear()
+
+
+def disable():
+    global _fd
+    with _lock:
+        if _fd is not None:
+            os.close(_fd)
+        _fd = None
+
+
+def _text(value):
+    """
+    value with its byte strings decoded for json (e.g. a file name that
+    is not UTF-8; the invalid bytes are replaced).
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict((_text(k), _text(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_text(v) for v in value]
+    # else
+    return value
+
+
+def _emit(event, thread):
+    """
+    Write an event (and the name of its thread the first time).
+    Each event is a single append, so the lines of the processes don't mix.
+    An event that cannot be serialised is dropped.
+    """
+    key = (event['pid'], event['tid'])
+    lines = []
+    try:
+        if key not in _named:
+            lines.append(json.dumps(_text({'name': 'thread_name', 'ph': 'M', 'pid': event['pid'],
+                                           'tid': event['tid'], 'args': {'name': thread.name}})) + ',\n')
+        lines.append(json.dumps(_text(event)) + ',\n')
+    except (TypeError, ValueError):
+        return
+    with _lock:
+        if _fd is None:
+            return
+        # else
+        _named.add(key)
+        try:
+            os.write(_fd, ''.join(lines))
+        except OSError:
+            pass    # e.g. the disk is full; the conversion goes on
+
+
+if os.environ.get(ENV_VAR):
+    try:
+        enable(os.environ[ENV_VAR])
+    except OSError as e:
+        import sys
+        print >>sys.stderr, "# tracing is off: {0}".format(e)
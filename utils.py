@@ -1,16 +1,26 @@
 #!/usr/bin/env python
 
+import os
 import re
-import platform as p
-import uuid
-import hashlib
 import time
 import shlex
 from subprocess import Popen, PIPE, STDOUT
 from datetime import timedelta
 from time import strftime
+from threading import Lock
+import tracing
 
-video_info = "/usr/bin/mplayer '{0}' -ao null -vo null -frames 1 -identify"
+# The heavier modules (platform, uuid, hashlib, multiprocessing, sqlite3, ...)
+# are imported by the functions that need them, to keep the startup fast.
+
+MPLAYER = '/usr/bin/mplayer'
+video_info = "{mplayer} '{0}' -ao null -vo null -frames 1 -identify"
+
+# wait "forever" for a pool; a timeout is needed so that Ctrl+C works in Python 2
+POOL_TIMEOUT = 365 * 24 * 3600
+
+_probe_cache = None
+_probe_cache_lock = Lock()
 
 
 class Timer(object):
@@ -29,6 +39,7 @@ def string_to_md5(content):
     """Calculate the md5 hash of a string.
 
     This 'string' can be the binary content of a file too."""
+    import hashlib
     return hashlib.md5(content).hexdigest()
 
 
@@ -38,6 +49,8 @@ def get_fingerprint(md5=False):
 
     If md5 is True, a digital fingerprint is returned.
     """
+    import platform as p
+    import uuid
     sb = []
     sb.append(p.node())
     sb.append(p.architecture()[0])
@@ -70,6 +83,63 @@ def call_and_get_exit_code(cmd):
     return process.wait()
 
 
+def cpu_count():
+    """
+    Number of CPU cores. If it cannot be determined, return 1.
+    """
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def parallel_map(func, items, size):
+    """
+    Like map(func, items), but with at most size threads at the same time.
+
+    The results are in the order of items.
+    """
+    from multiprocessing.pool import ThreadPool
+    size = min(size, len(items))
+    if size <= 1:
+        return [func(item) for item in items]
+    # else
+    pool = ThreadPool(size)
+    try:
+        results = pool.map_async(func, items, chunksize=1).get(POOL_TIMEOUT)
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+
+def parallel_imap(func, items, size):
+    """
+    Like parallel_map(), but yield the results as soon as they are ready,
+    in the order of completion. The results are not collected.
+    """
+    from multiprocessing.pool import ThreadPool
+    size = min(size, len(items))
+    if size <= 1:
+        for item in items:
+            yield func(item)
+        return
+    # else
+    pool = ThreadPool(size)
+    try:
+        it = pool.imap_unordered(func, items, chunksize=1)
+        for _ in range(len(items)):
+            yield it.next(POOL_TIMEOUT)
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+
 def sizeof_fmt(num):
     """
     Convert file size to human readable format.
@@ -91,23 +161,87 @@ def get_simple_cmd_output(cmd, stderr=STDOUT):
     return Popen(args, stdout=PIPE, stderr=stderr).communicate()[0]
 
 
-def get_video_info(video_file):
+def get_mplayer_info(video_file):
+    """
+    Get info about a video with mplayer (slow, a frame is decoded).
+    """
+    cmd = video_info.format(video_file, mplayer=MPLAYER)
+    output = get_simple_cmd_output(cmd)
+    return dict(re.findall('(ID_.*)=(.*)', output))
+
+
+def get_cache_dir():
+    """
+    Directory of the persistent caches (created if necessary).
+
+    $XDG_CACHE_HOME/movie2android, which is ~/.cache/movie2android by default.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'movie2android')
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass    # created by another process in the meantime or not writable
+    return path
+
+
+def get_probe_cache():
+    """
+    The shared probe cache of the process (created on first use).
+    """
+    global _probe_cache
+    with _probe_cache_lock:
+        if _probe_cache is None:
+            import probecache
+            db_file = os.path.join(get_cache_dir(), 'probe.sqlite')
+            _probe_cache = probecache.ProbeCache(db_file)
+    return _probe_cache
+
+
+def get_video_info(video_file, use_cache=True):
     """
     Get info about a video.
 
-    The info is returned by mplayer. The result is a
+    The info is read from the container header (MP4/MOV, AVI, MKV).
+    For other formats it is returned by mplayer. The result is a
     dictionary whose keys start with 'ID_'.
+
+    The info of unchanged files is served from the probe cache,
+    thus a file is probed only once.
     """
-    cmd = video_info.format(video_file)
-    output = get_simple_cmd_output(cmd)
-    return dict(re.findall('(ID_.*)=(.*)', output))
+    with tracing.span('probe', file=video_file) as span:
+        cache = get_probe_cache() if use_cache else None
+        key = None
+        if cache:
+            try:
+                key = cache.key(video_file)
+            except OSError:
+                key = None
+            if key:
+                info = cache.get(key)
+                if info is not None:
+                    span.set(source='cache')
+                    return info
+        #
+        import container
+        info = container.get_info(video_file)
+        if info is None:
+            with tracing.span('mplayer', file=video_file):
+                info = get_mplayer_info(video_file)
+            span.set(source='mplayer')
+        else:
+            span.set(source='container')
+        if key and 'ID_LENGTH' in info:
+            cache.put(key, info)
+        return info
 
 
 def get_video_length(video_file):
     """
     Get the length of a video in seconds.
 
-    The length is extracted with mplayer.
+    The length is extracted with get_video_info().
     The return value is a real number.
     """
     info = get_video_info(video_file)